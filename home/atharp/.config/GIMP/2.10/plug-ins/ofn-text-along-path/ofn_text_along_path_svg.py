@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+# SVG guide paths for ofn-text-along-path: reads the paths of an SVG file
+# as strokes, without going through Gimp.
+# (c) Ofnuts 2012, 2017
+#
+# The strokes are in Gimp's format, (points,closed) tuples where points are
+# triplets of coordinate pairs (backward handle, anchor, forward handle), so
+# they can be used to create Gimp strokes, or with the Stroke class of the
+# engine for DirectionStroke.
+#
+# All path data commands (M/L/H/V/C/S/Q/T/A/Z) and transforms are supported.
+# Lines and quadratic curves are converted exactly to cubic curves, elliptical
+# arcs are approximated with one cubic curve per quarter of ellipse (within
+# 0.03% of the radius). Only <path> elements are read, and <use> isn't
+# followed.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# If you alter this program and redistribute it, please make it clear
+# that you are the author/maintainer of that version. Thank you.
+
+from __future__ import print_function, division
+
+import math, re
+import xml.etree.ElementTree as ElementTree
+
+from ofn_text_along_path_engine import Stroke, trace
+
+#----------------------------------------------------
+# Affine transforms, as the (a,b,c,d,e,f) tuples of SVG's matrix():
+# x'=a*x+c*y+e, y'=b*x+d*y+f
+#----------------------------------------------------
+identity=(1.,0.,0.,1.,0.,0.)
+
+# Transform m applied after transform n
+def multiply(m,n):
+    a,b,c,d,e,f=m
+    na,nb,nc,nd,ne,nf=n
+    return (a*na+c*nb,b*na+d*nb,a*nc+c*nd,b*nc+d*nd,a*ne+c*nf+e,b*ne+d*nf+f)
+
+def transformPoints(m,points):
+    a,b,c,d,e,f=m
+    xs,ys=points[0::2],points[1::2]
+    moved=[0.]*len(points)
+    moved[0::2]=[a*x+c*y+e for x,y in zip(xs,ys)]
+    moved[1::2]=[b*x+d*y+f for x,y in zip(xs,ys)]
+    return moved
+
+numberPattern=re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+transformPattern=re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+
+def numbers(text):
+    return [float(n) for n in numberPattern.findall(text)]
+
+def parseTransform(text):
+    m=identity
+    for name,args in transformPattern.findall(text or ''):
+        v=numbers(args)
+        if name=='matrix':
+            t=tuple(v[:6])
+        elif name=='translate':
+            t=(1.,0.,0.,1.,v[0],v[1] if len(v)>1 else 0.)
+        elif name=='scale':
+            t=(v[0],0.,0.,v[1] if len(v)>1 else v[0],0.,0.)
+        elif name=='rotate':
+            theta=math.radians(v[0])
+            cos,sin=math.cos(theta),math.sin(theta)
+            t=(cos,sin,-sin,cos,0.,0.)
+            if len(v)>2: # Around (cx,cy)
+                t=multiply((1.,0.,0.,1.,v[1],v[2]),multiply(t,(1.,0.,0.,1.,-v[1],-v[2])))
+        elif name=='skewX':
+            t=(1.,0.,math.tan(math.radians(v[0])),1.,0.,0.)
+        else: # skewY
+            t=(1.,math.tan(math.radians(v[0])),0.,1.,0.,0.)
+        m=multiply(m,t)
+    return m
+
+#----------------------------------------------------
+# Stroke under construction, in Gimp's format. A curve goes from the
+# forward handle of an anchor to the backward handle of the next one,
+# so a straight segment is a curve with the handles on the anchors.
+#----------------------------------------------------
+class StrokeBuilder(object):
+    def __init__(self,x,y):
+        self.points=[x,y,x,y,x,y]
+
+    def curveTo(self,x1,y1,x2,y2,x,y):
+        self.points[-2:]=[x1,y1]
+        self.points+=[x2,y2,x,y,x,y]
+
+    def lineTo(self,x,y):
+        self.points+=[x,y,x,y,x,y]
+
+    # When the stroke ends on its start, the last anchor is merged with
+    # the first one, otherwise the closing segment is straight.
+    def close(self):
+        points=self.points
+        if len(points)>6 and points[-4:-2]==points[2:4]:
+            points[0:2]=points[-6:-4]
+            del points[-6:]
+
+#----------------------------------------------------
+# Path data
+#----------------------------------------------------
+class PathDataError(Exception):
+    pass
+
+commandPattern=re.compile(r'[\s,]*([MmLlHhVvCcSsQqTtAaZz])')
+separatorPattern=re.compile(r'[\s,]*')
+argumentCounts={'M':2,'L':2,'H':1,'V':1,'C':6,'S':4,'Q':4,'T':2,'A':7,'Z':0}
+
+# Reads the path data as a sequence of (command,arguments) tuples,
+# with the implicit repetitions of the commands made explicit
+def pathCommands(data):
+    pos=0
+    end=len(data.rstrip())
+    while pos<end:
+        match=commandPattern.match(data,pos)
+        if not match:
+            raise PathDataError('Unexpected "%s" in path data' % data[pos:pos+10])
+        command=match.group(1)
+        pos=match.end()
+        count=argumentCounts[command.upper()]
+        if not count:
+            yield command,[]
+            continue
+        first=True
+        while True:
+            arguments=[]
+            for i in range(count):
+                pos=separatorPattern.match(data,pos).end()
+                if command in 'Aa' and i in (3,4) and data[pos:pos+1] in ('0','1'): # Flags, possibly not separated
+                    arguments.append(float(data[pos]))
+                    pos+=1
+                    continue
+                number=numberPattern.match(data,pos)
+                if not number:
+                    break
+                arguments.append(float(number.group()))
+                pos=number.end()
+            if len(arguments)<count:
+                if first or arguments:
+                    raise PathDataError('Missing arguments for "%s" in path data' % command)
+                break
+            yield command,arguments
+            first=False
+            if command in 'Mm': # Next pairs are implicit line commands
+                command='l' if command=='m' else 'L'
+
+# Cubic curves (as lists of six coordinates) for an elliptical arc,
+# one for each quarter of ellipse or less (see the SVG implementation
+# notes for the conversion from endpoints to center)
+def arcCurves(x0,y0,rx,ry,angle,largeArc,sweep,x,y):
+    phi=math.radians(angle)
+    cos,sin=math.cos(phi),math.sin(phi)
+    dx,dy=(x0-x)/2.,(y0-y)/2.
+    x1=cos*dx+sin*dy
+    y1=-sin*dx+cos*dy
+    rx,ry=abs(rx),abs(ry)
+    scale=(x1*x1)/(rx*rx)+(y1*y1)/(ry*ry)
+    if scale>1: # Radii too small, scaled up
+        rx,ry=rx*math.sqrt(scale),ry*math.sqrt(scale)
+    num=rx*rx*ry*ry-rx*rx*y1*y1-ry*ry*x1*x1
+    den=rx*rx*y1*y1+ry*ry*x1*x1
+    coef=math.sqrt(max(0.,num/den))
+    if largeArc==sweep:
+        coef=-coef
+    cx1,cy1=coef*rx*y1/ry,-coef*ry*x1/rx
+    cx=cos*cx1-sin*cy1+(x0+x)/2.
+    cy=sin*cx1+cos*cy1+(y0+y)/2.
+    theta1=math.atan2((y1-cy1)/ry,(x1-cx1)/rx)
+    delta=math.atan2((-y1-cy1)/ry,(-x1-cx1)/rx)-theta1
+    if sweep and delta<0:
+        delta+=2*math.pi
+    elif not sweep and delta>0:
+        delta-=2*math.pi
+
+    segments=max(1,int(math.ceil(abs(delta)/(math.pi/2)-1e-9)))
+    step=delta/segments
+    k=4./3.*math.tan(step/4.)
+    # Point and derivative on the ellipse at angle t
+    def point(t):
+        ex,ey=rx*math.cos(t),ry*math.sin(t)
+        return cx+cos*ex-sin*ey,cy+sin*ex+cos*ey
+    def tangent(t):
+        ex,ey=-rx*math.sin(t),ry*math.cos(t)
+        return cos*ex-sin*ey,sin*ex+cos*ey
+    curves=[]
+    for i in range(segments):
+        t0,t1=theta1+i*step,theta1+(i+1)*step
+        px0,py0=point(t0)
+        tx0,ty0=tangent(t0)
+        px1,py1=point(t1)
+        tx1,ty1=tangent(t1)
+        curves.append([px0+k*tx0,py0+k*ty0,px1-k*tx1,py1-k*ty1,px1,py1])
+    curves[-1][4:6]=[x,y] # Exact end point
+    return curves
+
+# Strokes of the path data, as (points,closed) tuples. Strokes with
+# a single anchor are dropped, since nothing can be laid out on them.
+def parsePathData(data):
+    strokes=[]
+    stroke=None
+    x=y=startX=startY=0.
+    lastControl=None # (command type,x,y) of the last curve control point, for S and T
+    def finish(closed):
+        if stroke and len(stroke.points)>6:
+            strokes.append((stroke.points,closed))
+    for command,args in pathCommands(data):
+        upper=command.upper()
+        relative=command!=upper
+        control=None
+        if upper=='M':
+            finish(False)
+            x,y=(x+args[0],y+args[1]) if relative else (args[0],args[1])
+            startX,startY=x,y
+            stroke=StrokeBuilder(x,y)
+        elif upper=='Z':
+            if stroke:
+                stroke.close()
+                finish(True)
+            stroke=StrokeBuilder(startX,startY) # Drawing can go on from the start point
+            x,y=startX,startY
+        else:
+            if stroke is None:
+                raise PathDataError('Path data doesn\'t start with a "moveto"')
+            if upper=='L':
+                x,y=(x+args[0],y+args[1]) if relative else (args[0],args[1])
+                stroke.lineTo(x,y)
+            elif upper=='H':
+                x=x+args[0] if relative else args[0]
+                stroke.lineTo(x,y)
+            elif upper=='V':
+                y=y+args[0] if relative else args[0]
+                stroke.lineTo(x,y)
+            elif upper in 'CS':
+                if upper=='C':
+                    x1,y1,x2,y2,ex,ey=args
+                    if relative:
+                        x1,y1=x+x1,y+y1
+                else:
+                    x2,y2,ex,ey=args
+                    x1,y1=(2*x-lastControl[1],2*y-lastControl[2]) if lastControl and lastControl[0]=='C' else (x,y)
+                if relative:
+                    x2,y2,ex,ey=x+x2,y+y2,x+ex,y+ey
+                stroke.curveTo(x1,y1,x2,y2,ex,ey)
+                x,y=ex,ey
+                control=('C',x2,y2)
+            elif upper in 'QT':
+                if upper=='Q':
+                    qx,qy,ex,ey=args
+                    if relative:
+                        qx,qy=x+qx,y+qy
+                else:
+                    ex,ey=args
+                    qx,qy=(2*x-lastControl[1],2*y-lastControl[2]) if lastControl and lastControl[0]=='Q' else (x,y)
+                if relative:
+                    ex,ey=x+ex,y+ey
+                # Exact conversion: the cubic handles are at 2/3 of the way to the quadratic control point
+                stroke.curveTo(x+2.*(qx-x)/3.,y+2.*(qy-y)/3.,ex+2.*(qx-ex)/3.,ey+2.*(qy-ey)/3.,ex,ey)
+                x,y=ex,ey
+                control=('Q',qx,qy)
+            else: # A
+                rx,ry,angle,largeArc,sweep,ex,ey=args
+                if relative:
+                    ex,ey=x+ex,y+ey
+                if (ex,ey)==(x,y):
+                    pass # Nothing drawn
+                elif not (rx and ry):
+                    stroke.lineTo(ex,ey)
+                else:
+                    for curve in arcCurves(x,y,rx,ry,angle,bool(largeArc),bool(sweep),ex,ey):
+                        stroke.curveTo(*curve)
+                x,y=ex,ey
+        lastControl=control
+    finish(False)
+    return strokes
+
+#----------------------------------------------------
+# SVG file
+#----------------------------------------------------
+svgNamespace='{http://www.w3.org/2000/svg}'
+skippedElements=set(['defs','clipPath','mask','marker','pattern','symbol','metadata'])
+unitSizes={'px':1.,'pt':96./72.,'pc':16.,'mm':96./25.4,'cm':96./2.54,'in':96.} # CSS pixels, 96 per inch
+lengthPattern=re.compile(r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(px|pt|pc|mm|cm|in|%)?\s*$')
+
+def parseLength(text):
+    match=lengthPattern.match(text or '')
+    if not match or match.group(2)=='%':
+        return None
+    return float(match.group(1))*unitSizes[match.group(2) or 'px']
+
+def localName(tag):
+    return tag[len(svgNamespace):] if tag.startswith(svgNamespace) else tag
+
+# Reads the paths of an SVG file. Returns (width,height,paths) where
+# the size is in pixels, and paths is a list of (id,strokes) tuples, the
+# strokes being in pixels in the image, with all transforms applied.
+def readSVGPaths(fileName):
+    root=ElementTree.parse(fileName).getroot()
+    width,height=parseLength(root.get('width')),parseLength(root.get('height'))
+    viewBox=numbers(root.get('viewBox') or '')
+    rootTransform=identity
+    if len(viewBox)==4 and viewBox[2]>0 and viewBox[3]>0:
+        vx,vy,vw,vh=viewBox
+        width,height=width or vw,height or vh
+        rootTransform=(width/vw,0.,0.,height/vh,-vx*width/vw,-vy*height/vh)
+    paths=[]
+    def walk(element,transform):
+        name=localName(element.tag)
+        if name in skippedElements:
+            return
+        transform=multiply(transform,parseTransform(element.get('transform')))
+        if name=='path':
+            strokes=[(transformPoints(transform,points),closed) for points,closed in parsePathData(element.get('d') or '')]
+            if strokes:
+                paths.append((element.get('id') or 'path%d' % (len(paths)+1),strokes))
+        for child in element:
+            walk(child,transform)
+    walk(root,rootTransform)
+    if not (width and height): # No size, use the extent of the paths
+        xs=[x for _,strokes in paths for points,_ in strokes for x in points[0::2]] or [0.]
+        ys=[y for _,strokes in paths for points,_ in strokes for y in points[1::2]] or [0.]
+        width,height=width or max(xs),height or max(ys)
+    trace('geometry','SVG file %s: %3.2fx%3.2f, %d paths',fileName,width,height,len(paths))
+    return width,height,paths
+
+# Strokes of the SVG file for the engine (all paths, or only the one with
+# the given id), for instance to use with DirectionStroke outside of Gimp
+def svgStrokes(fileName,pathId=None):
+    _,_,paths=readSVGPaths(fileName)
+    return [Stroke(points,closed) for name,strokes in paths if pathId is None or name==pathId
+                                  for points,closed in strokes]
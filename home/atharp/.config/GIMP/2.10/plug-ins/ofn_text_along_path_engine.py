@@ -0,0 +1,1454 @@
+# -*- coding: utf-8 -*-
+
+# Layout engine of ofn-text-along-path: stroke geometry, text layout and
+# path collection, without any dependency on Gimp.
+# (c) Ofnuts 2012, 2017
+#
+# The engine talks to the outside world through a few objects:
+#
+#   - glyph providers, that supply the font extents and the character
+#     outlines (see GlyphProvider)
+#   - strokes, that are any object with a "points" attribute that returns
+#     the (points,closed) tuple of a Gimp stroke (Gimp strokes as well as
+#     the Stroke class below)
+#   - path collectors, that receive the character outlines moved to their
+#     position (see PathCollector)
+#
+# So it can be used as is in a plain Python (2 or 3) interpreter, the Gimp
+# plugin being a thin adapter over it.
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation; either version 2 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program; if not, write to the Free Software
+#   Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+# If you alter this program and redistribute it, please make it clear
+# that you are the author/maintainer of that version. Thank you.
+
+from __future__ import print_function, division
+
+import math, random, os, bisect, itertools
+import tempfile, shutil
+
+from array import array
+
+from timeit import default_timer as timer
+
+from collections import namedtuple, OrderedDict, deque
+from xml.sax.saxutils import escape
+
+try:
+    import multiprocessing
+except ImportError: # Not in all embedded Pythons
+    multiprocessing=None
+
+try:
+    unicodeType=unicode
+except NameError: # Python 3
+    unicodeType=str
+
+debug='OFN_DEBUG' in os.environ
+
+def toUnicode(s):
+    return s if isinstance(s,unicodeType) else s.decode('utf-8','strict')
+
+def toBytes(s):
+    return s.encode('utf-8') if isinstance(s,unicodeType) else s
+
+#----------------------------------------------------
+# Profiling
+#
+# When the OFN_PROFILE environment variable is set, the time spent in each
+# phase of a run is accumulated, as well as the number of entries in the
+# phase and the number of PDB calls made in it (counted by the caller with
+# countCall()). Time and calls in a nested phase are not counted in the
+# enclosing one, and those outside of any phase go to "other". When
+# profiling is off, phase() returns a context manager that does nothing.
+#----------------------------------------------------
+class NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self,exc_type, exc_val, exc_tb):
+        return False
+
+class Phase(object):
+    def __init__(self,profiler,name):
+        self.profiler=profiler
+        self.name=name
+
+    def __enter__(self):
+        self.profiler.enterPhase(self.name)
+
+    def __exit__(self,exc_type, exc_val, exc_tb):
+        self.profiler.exitPhase()
+        return False
+
+class Profiler(object):
+    def __init__(self,enabled):
+        self.enabled=enabled
+        self.noPhase=NoPhase()
+        self.start()
+
+    # Start a new run
+    def start(self):
+        self.phases=OrderedDict() # name -> [time,calls,entries]
+        self.stack=[]
+        self.startTime=self.phaseStart=timer()
+
+    def phase(self,name):
+        return Phase(self,name) if self.enabled else self.noPhase
+
+    def stats(self,name):
+        stats=self.phases.get(name)
+        if not stats:
+            stats=self.phases[name]=[0.,0,0]
+        return stats
+
+    # Time since the last phase change goes to the current phase
+    def accumulate(self):
+        now=timer()
+        if self.stack:
+            self.stats(self.stack[-1])[0]+=now-self.phaseStart
+        self.phaseStart=now
+
+    def enterPhase(self,name):
+        self.accumulate()
+        self.stack.append(name)
+        self.stats(name)[2]+=1
+
+    def exitPhase(self):
+        self.accumulate()
+        self.stack.pop()
+
+    def countCall(self):
+        if self.enabled:
+            self.stats(self.stack[-1] if self.stack else 'other')[1]+=1
+
+    # Summary of the run, as a dictionary ready for JSON
+    def summary(self,**info):
+        total=timer()-self.startTime
+        other=self.stats('other')
+        other[0]=total-sum(stats[0] for name,stats in self.phases.items() if name!='other')
+        summary=dict(info)
+        summary['total']=total
+        summary['phases']=OrderedDict((name,{'time':time,'calls':calls,'entries':entries})
+                                      for name,(time,calls,entries) in self.phases.items())
+        return summary
+
+profiler=Profiler('OFN_PROFILE' in os.environ)
+
+# Init with [(symbol,label)...((symbol,label)]
+def createOpts(name,pairs):
+    optsclass=namedtuple(name+'Type',[symbol for symbol,label in pairs]+['labels','labelTuples'])
+    opts=optsclass(*(
+                    list(range(len(pairs)))
+                    +[[label for symbol,label in pairs]]
+                    +[[(label,i) for i,(symbol,label) in enumerate(pairs)]]
+                    ))
+    return opts
+
+# Init with [(symbol,label,value,)...((symbol,label,value)]
+def createValuedOpts(name,triplets):
+    optsclass=namedtuple(name+'Type',[symbol for symbol,_,_ in triplets]+['labels','labelTuples','values'])
+    opts=optsclass(*(
+                    list(range(len(triplets)))
+                    +[[label for _,label,_ in triplets]]
+                    +[[(label,i) for i,(_,label,_) in enumerate(triplets)]]
+                    +[[value for _,_,value in triplets]]
+                    ))
+    return opts
+
+#----------------------------------------------------
+# Tracing
+#
+# Trace records have a category (general, font, geometry, layout, kerning,
+# collector) and a level. The message is formatted only when the record is
+# kept: it is either a format string and its arguments, or a callable that
+# returns the message. Records are printed when:
+#
+#   - OFN_DEBUG is set (all categories, all levels)
+#   - OFN_TRACE is set to a comma-separated list of categories
+#
+# OFN_TRACE_LEVEL (debug, info, warning) sets the lowest printed level.
+# With OFN_TRACE_BUFFER set to a number, the last records are also kept in
+# memory (whether printed or not), and dumped when the script fails. When
+# nothing is kept, tracer.active is False, and call sites in loops test it
+# before calling trace(), so that they cost only this check.
+#----------------------------------------------------
+TraceLevel=createOpts('TraceLevel',[('DEBUG','debug'),('INFO','info'),('WARNING','warning')])
+traceCategories=['general','font','geometry','layout','kerning','collector']
+
+class Tracer(object):
+    def __init__(self,printLevel=None,categories=None,bufferSize=0):
+        self.configure(printLevel,categories,bufferSize)
+
+    # printLevel: lowest printed level (None: no printing)
+    # categories: traced categories (None: all)
+    # bufferSize: number of records kept in memory (0: none)
+    def configure(self,printLevel,categories=None,bufferSize=0):
+        self.printLevel=printLevel
+        self.categories=set(categories) if categories else None
+        self.buffer=deque(maxlen=bufferSize) if bufferSize else None
+        self.active=printLevel is not None or self.buffer is not None
+
+    def log(self,category,level,message,*args):
+        if not self.active or (self.categories and category not in self.categories):
+            return
+        printed=self.printLevel is not None and level>=self.printLevel
+        if not (printed or self.buffer is not None):
+            return
+        if callable(message):
+            message=message()
+        elif args:
+            message=message % args
+        if self.buffer is not None:
+            self.buffer.append((timer(),category,level,message))
+        if printed:
+            print(message)
+
+    def records(self):
+        return list(self.buffer) if self.buffer else []
+
+    # Print the kept records, with their time relative to the first one
+    def dump(self):
+        records=self.records()
+        for time,category,level,message in records:
+            print('%10.4f %-9s %-7s %s' % (time-records[0][0],category,TraceLevel.labels[level],message))
+
+# Misspelled settings fall back to their defaults, and are reported once
+# the tracer is created, rather than stopping the plug-in registration
+def createTracer():
+    categories=os.getenv('OFN_TRACE')
+    printLevel=None
+    errors=[]
+    if debug or categories:
+        level=os.getenv('OFN_TRACE_LEVEL','debug').lower()
+        if level in TraceLevel.labels:
+            printLevel=TraceLevel.labels.index(level)
+        else:
+            printLevel=TraceLevel.DEBUG
+            errors.append('Unknown OFN_TRACE_LEVEL "%s", using debug' % level)
+    try:
+        bufferSize=int(os.getenv('OFN_TRACE_BUFFER',0))
+    except ValueError:
+        bufferSize=0
+        errors.append('Invalid OFN_TRACE_BUFFER "%s", no buffer' % os.getenv('OFN_TRACE_BUFFER'))
+    tracer=Tracer(printLevel,categories.split(',') if categories else None,bufferSize)
+    for error in errors:
+        tracer.log('general',TraceLevel.WARNING,error)
+    return tracer
+
+tracer=createTracer()
+
+# Debug-level trace
+def trace(category,message,*args):
+    if tracer.active:
+        tracer.log(category,TraceLevel.DEBUG,message,*args)
+
+# To set the text on the target path, each character is given a "pivot point".
+# This point is the point to be moved to the target path, as well as the center
+# of rotation to adjust the character tilt. The X coordinate of the pivot point
+# is always the middle of the character box (single-character text layer).
+# The Y coordinate is  the combination of an adjustment value, and one of the
+# following heights:
+
+Pivot=createOpts('Pivot',
+    [
+    ('BASELINE',  'Baseline'),                      # The baseline
+    ('TOP',       'Top of box'),                    # The top of the character box
+    ('BOTTOM',    'Bottom of box'),                 # The bottom of the character box
+    ('BOXMIDDLE', 'Middle of box'),                 # The middle of the character box
+    ('UCTOP',     'Top of uppercase'),              # The top of uppercase characters
+    ('UCMIDDLE',  'Middle of uppercase'),           # The middle of uppercase characters
+    ('LCTOP',     'Top of lowercase'),              # The top of "regular" lowercase characters
+    ('LCMIDDLE',  'Middle of lowercase'),           # The middle of "regular" lowercase characters
+    ])
+
+# Characters that won't produce a path (space, etc...)
+blankCharacters=' '
+
+# Text formatting over the path.
+# CENTER/LEFT/RIGHT will use the defined extra spacing
+# JUSTIFY/REPEAT compute an extra spacing to fit the stroke width
+Layout=createOpts('Layout',
+                    [('LEFT','Left'),('RIGHT','Right'),('CENTER','Center'),
+                    ('JUSTIFY','Justify'),('REPEAT','Repeat')])
+
+def dumpStrokes(strokes):
+    for points,closed in strokes:
+        print('---')
+        for i in range(0,len(points),6):
+            print('***%7.2f,%7.2f <--- %7.2f,%7.2f ---> %7.2f,%7.2f' % tuple((points[i:i+6])))
+
+#----------------------------------------------------
+# Bézier curves
+#
+# Gimp stroke points are triplets of coordinate pairs: backward handle,
+# anchor, forward handle. Each curve goes from an anchor to the next one,
+# using the forward handle of the first and the backward handle of the second.
+# Curves are kept as (x0,y0,x1,y1,x2,y2,x3,y3) tuples.
+#----------------------------------------------------
+def strokeCurves(points,closed):
+    anchors=len(points)//6
+    curves=[]
+    for i in range(anchors if closed else anchors-1):
+        j=(i+1)%anchors
+        curves.append(tuple(points[6*i+2:6*i+6])+tuple(points[6*j:6*j+4]))
+    return curves
+
+def curvePoint(curve,t):
+    x0,y0,x1,y1,x2,y2,x3,y3=curve
+    u=1-t
+    a,b,c,d=u*u*u,3*u*u*t,3*u*t*t,t*t*t
+    return a*x0+b*x1+c*x2+d*x3,a*y0+b*y1+c*y2+d*y3
+
+# Tangent (derivative) at t. When handles are retracted on their anchor the
+# derivative vanishes at the curve ends, and the direction is then given by
+# the next distinct control point.
+def curveTangent(curve,t):
+    x0,y0,x1,y1,x2,y2,x3,y3=curve
+    u=1-t
+    a,b,c=3*u*u,6*u*t,3*t*t
+    dx=a*(x1-x0)+b*(x2-x1)+c*(x3-x2)
+    dy=a*(y1-y0)+b*(y2-y1)+c*(y3-y2)
+    if abs(dx)+abs(dy)<1e-9:
+        if t<.5:
+            candidates=[(x1-x0,y1-y0),(x2-x0,y2-y0),(x3-x0,y3-y0)]
+        else:
+            candidates=[(x3-x2,y3-y2),(x3-x1,y3-y1),(x3-x0,y3-y0)]
+        for dx,dy in candidates:
+            if abs(dx)+abs(dy)>=1e-9:
+                break
+    return dx,dy
+
+# Gauss-Legendre quadrature nodes and weights (5 points, over [0,1])
+gaussLegendre=[(.5+.5*x,.5*w) for x,w in [
+                    (-.9061798459386640,.2369268850561891),
+                    (-.5384693101056831,.4786286704993665),
+                    (0.,                .5688888888888889),
+                    ( .5384693101056831,.4786286704993665),
+                    ( .9061798459386640,.2369268850561891)]]
+
+# Length of the curve between t0 and t1
+def curveLength(curve,t0,t1):
+    x0,y0,x1,y1,x2,y2,x3,y3=curve
+    h=t1-t0
+    length=0.
+    for x,w in gaussLegendre:
+        t=t0+h*x
+        u=1-t
+        a,b,c=3*u*u,6*u*t,3*t*t
+        length+=w*math.hypot(a*(x1-x0)+b*(x2-x1)+c*(x3-x2),a*(y1-y0)+b*(y2-y1)+c*(y3-y2))
+    return length*h
+
+#----------------------------------------------------
+# Stroke outside of Gimp, with the same "points" as a Gimp stroke
+#----------------------------------------------------
+class Stroke(object):
+    def __init__(self,points,closed):
+        self.points=(list(points),closed)
+
+#----------------------------------------------------
+# Enhanced path Stroke
+#
+# The control points are read once, and an arc-length table (cumulative
+# distance at curve parameters) is built from them. Points at a given
+# distance are then found by inverting the table, without going through
+# the PDB again.
+#
+# Each curve is split until the quadrature of its halves agrees with that
+# of the whole, and the points found by interpolating in the table at the
+# first and third quarter of the piece are within half the tolerance of
+# the actual points (the middle point can't be used, since the error
+# vanishes there on symmetrical pieces such as straight segments). The
+# largest error on a piece is not exactly at the quarters, and can reach
+# 1.3 times the error there, so checking against half the tolerance keeps
+# every position within the tolerance. So the table size
+# depends on the curve complexity and the tolerance, and not on the number
+# of curves. The tolerance (in pixels) can be set with the
+# OFN_TEXT_ALONG_PATH_TOLERANCE environment variable.
+#
+# The optional geometry cache is any object with get(points,closed,tolerance)
+# (returning the (dists,params) tables or None) and put(points,closed,
+# tolerance,dists,params) methods.
+#----------------------------------------------------
+class DirectionStroke:
+    tolerance=float(os.getenv('OFN_TEXT_ALONG_PATH_TOLERANCE',.1))
+    maxSplits=16 # Bounds the recursion on degenerate curves
+
+    def __init__(self,stroke,backwards,geometryCache=None):
+        self.stroke=stroke
+        self.backwards=backwards
+        with profiler.phase('geometry'):
+            self.points,self.closed=self.stroke.points
+            self.curves=strokeCurves(self.points,self.closed)
+            table=geometryCache.get(self.points,self.closed,self.tolerance) if geometryCache else None
+            if table:
+                self.dists,self.params=table
+            else:
+                self.dists,self.params=self.buildLengthTable()
+                if geometryCache:
+                    geometryCache.put(self.points,self.closed,self.tolerance,self.dists,self.params)
+        self.length=self.dists[-1]
+
+    # Returns the cumulative distances and the matching curve parameters
+    # (index of curve + t on curve)
+    def buildLengthTable(self):
+        dists=[0.]
+        params=[0.]
+        for i,curve in enumerate(self.curves):
+            self.splitCurve(curve,i,0.,1.,curveLength(curve,0.,1.),0,dists,params)
+        trace('geometry','Stroke with %d curves, length %3.2f: %d table entries',len(self.curves),dists[-1],len(dists))
+        return dists,params
+
+    # Distance between the point at t and the point obtained by linear
+    # interpolation at the length from t0 to t
+    def interpolationError(self,curve,t0,t1,t,lengthToT,length):
+        x,y=curvePoint(curve,t)
+        xi,yi=curvePoint(curve,t0+(t1-t0)*lengthToT/length)
+        return math.hypot(xi-x,yi-y)
+
+    # Add table entries for the curve between t0 and t1, splitting it as
+    # long as the length or the interpolated points are not within tolerance
+    def splitCurve(self,curve,i,t0,t1,length,splits,dists,params):
+        tm=(t0+t1)/2.
+        left=curveLength(curve,t0,tm)
+        right=curveLength(curve,tm,t1)
+        fits=abs(left+right-length)<=self.tolerance
+        if fits and left+right:
+            q1,q3=(t0+tm)/2.,(tm+t1)/2.
+            fits=(self.interpolationError(curve,t0,t1,q1,curveLength(curve,t0,q1),left+right)<=self.tolerance/2. and
+                  self.interpolationError(curve,t0,t1,q3,left+curveLength(curve,tm,q3),left+right)<=self.tolerance/2.)
+        if fits or splits>=self.maxSplits:
+            dists.append(dists[-1]+left+right)
+            params.append(i+t1)
+        else:
+            self.splitCurve(curve,i,t0,tm,left,splits+1,dists,params)
+            self.splitCurve(curve,i,tm,t1,right,splits+1,dists,params)
+
+    # Curve parameter at distance, interpolated between table entries i-1 and i
+    # where i is the first entry not below the distance
+    def interpolateParam(self,i,dist):
+        if i==0:
+            return 0.
+        if i==len(self.dists):
+            return self.params[-1]
+        d0,d1=self.dists[i-1],self.dists[i]
+        p0,p1=self.params[i-1],self.params[i]
+        return p0+(p1-p0)*(dist-d0)/(d1-d0)
+
+    def paramAtDist(self,dist):
+        return self.interpolateParam(bisect.bisect_left(self.dists,dist),dist)
+
+    # Same as above for a sequence of distances. When the distances are
+    # sorted (as character positions are) the table is swept only once
+    # from the first one.
+    def paramsAtDists(self,dists):
+        table=self.dists
+        n=len(table)
+        params=[]
+        i=0
+        for dist in dists:
+            if not i or table[i-1]>=dist: # First one, or going back, search
+                i=bisect.bisect_left(table,dist)
+            while i<n and table[i]<dist:
+                i+=1
+            params.append(self.interpolateParam(i,dist))
+        return params
+
+    # Point and oriented tangent angle at curve parameter
+    def pointAtParam(self,param):
+        i=min(int(param),len(self.curves)-1)
+        curve=self.curves[i]
+        x,y=curvePoint(curve,param-i)
+        dx,dy=curveTangent(curve,param-i)
+        if self.backwards:
+            dx,dy=-dx,-dy
+        return x,y,math.atan2(dy,dx)
+
+    # Enhanced version of stroke.get_point_at_dist(...) that also returns
+    # the direction of the path. Since the direction is obtained from the
+    # curve derivative, this is valid over the whole stroke, extremities included.
+    def getPointAtDist(self,dist):
+        if self.backwards:
+            dist=self.length-dist
+        x,y,theta=self.pointAtParam(self.paramAtDist(dist))
+        #trace('geometry',"D: %3.2f -> %3.2f, %3.2f @%3.2f°",dist,x,y,theta*180/math.pi)
+        return (x,y,theta)
+
+    # Batch version of getPointAtDist(), returns the lists of X, Y and theta
+    def getPointsAtDists(self,dists):
+        if not dists:
+            return [],[],[]
+        if self.backwards: # Walk the table in increasing order anyway
+            params=self.paramsAtDists([self.length-d for d in reversed(dists)])[::-1]
+        else:
+            params=self.paramsAtDists(dists)
+        xs,ys,thetas=zip(*[self.pointAtParam(param) for param in params])
+        return list(xs),list(ys),list(thetas)
+
+#---------------------------------------------------------------------------
+# Glyph providers
+#
+# These supply the font data to the Formatter:
+#
+#   - extents(text): (width,height,ascent,descent) of the text, as returned
+#     by gimp_text_get_extents_fontname()
+#   - outline(text): the strokes of the rendered text, as a list of
+#     (points,closed) tuples, in a box whose top left corner is at (0,0)
+#   - glyph(character): (width,height,strokes) of a single character,
+#     strokes being empty for blank characters
+#   - textOutline(text): the strokes of a whole text, for word rendering
+#
+# The default implementations of the last two use the first two, providers
+# can override them to use a cache.
+#---------------------------------------------------------------------------
+class GlyphProvider(object):
+    def __init__(self,fontName,fontSize):
+        self.fontName=fontName
+        self.fontSize=fontSize
+
+    def extents(self,text):
+        raise NotImplementedError
+
+    def outline(self,text):
+        raise NotImplementedError
+
+    def glyph(self,c):
+        width,height,_,_=self.extents(c)
+        strokes=[] if c in blankCharacters else self.outline(c)
+        return width,height,strokes
+
+    def textOutline(self,text):
+        return self.outline(text)
+
+#---------------------------------------------------------------------------
+# PathCollectors
+#
+# These objects accumulate the paths produced when laying out the characters.
+#
+# They are implemented as Python context managers, context exit triggering
+# the actual output of the paths (otherwise they are discarded). The
+# characters and their boxes are passed as Outlines (iterables of
+# (points,closed) tuples), with the position of their box and pivot, and
+# their tilt.
+#---------------------------------------------------------------------------
+
+class PathCollector(object):
+    def __init__(self,pathName,showBoxes):
+        self.pathName=pathName
+        self.showBoxes=showBoxes
+
+    # Overloaded by the classes that use them
+    def enterStroke(self,strokeIndex):
+        pass;
+
+    def enterCharacter(self,charIndex,char):
+        pass;
+
+    # The move (translation by cX,cY) and the rotation around the pivot
+    # (cX+pX,cY+pY) are combined in a single affine transform applied
+    # to the points, so that strokes are created at their final position.
+    def placement(self,cX,cY,pX,pY,tilt):
+        theta=math.radians(tilt)
+        cos,sin=math.cos(theta),math.sin(theta)
+        return cos,sin,cX+pX-pX*cos+pY*sin,cY+pY-pX*sin-pY*cos
+
+    def movePoints(self,points,placement):
+        cos,sin,tX,tY=placement
+        xs,ys=points[0::2],points[1::2]
+        moved=[0.]*len(points)
+        moved[0::2]=[tX+x*cos-y*sin for x,y in zip(xs,ys)]
+        moved[1::2]=[tY+x*sin+y*cos for x,y in zip(xs,ys)]
+        return moved
+
+    # All the points of an outline are moved in one pass over its flat
+    # coordinates, and then split in strokes
+    def moveOutline(self,outline,placement):
+        moved=self.movePoints(outline.coords,placement)
+        starts=outline.starts
+        return [(moved[starts[i]:starts[i+1]],closed) for i,closed in enumerate(outline.closed)]
+
+#---------------------------------------------------------------------------
+# SVG collectors
+#
+# These write the paths to an SVG file, with the same grouping as the
+# collectors of the Gimp plugin. Each path is accumulated in a temporary
+# file while it can still receive characters, and copied to the SVG file
+# when it is complete, so memory use doesn't grow with the output.
+#---------------------------------------------------------------------------
+
+# SVG path data for a stroke, using Gimp's (handle, anchor, handle) triplets
+def svgPathData(points,closed):
+    anchors=len(points)//6
+    if not anchors:
+        return ''
+    fmt=lambda *coords: ' '.join(['%.3f' % c for c in coords])
+    data=['M'+fmt(*points[2:4])]
+    for i in range(anchors if closed else anchors-1):
+        j=(i+1)%anchors
+        data.append('C'+fmt(*(list(points[6*i+4:6*i+6])+list(points[6*j:6*j+4]))))
+    if closed:
+        data.append('Z')
+    return ' '.join(data)+' '
+
+class SVGCollector(PathCollector):
+    def __init__(self,width,height,pathName,showBoxes,fileName,notify=None):
+        super(SVGCollector,self).__init__(toUnicode(pathName),showBoxes) # Names built in unicode, encoded when written
+        self.width=width
+        self.height=height
+        self.fileName=fileName
+        self.notify=notify # If set, called with a message when the file is written
+        self.svg=None
+        self.openPaths=OrderedDict() # name -> temporary file
+        self.pathCount=0
+
+    def __enter__(self):
+        self.svg=open(self.fileName+'.tmp','wb')
+        self.svg.write(b'<?xml version="1.0" encoding="UTF-8" standalone="no"?>\n')
+        self.svg.write(toBytes('<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="%d" height="%d" viewBox="0 0 %d %d">\n' %
+                        ((self.width,self.height)*2)))
+        self.startPaths()
+
+    def __exit__(self,exc_type, exc_val, exc_tb):
+        if not exc_type:  # Normal end
+            with profiler.phase('insertion'):
+                for name in list(self.openPaths):
+                    self.closePath(name)
+                self.svg.write(b'</svg>\n')
+                self.svg.close()
+                if os.name=='nt' and os.path.exists(self.fileName):
+                    os.remove(self.fileName) # No atomic replace on Windows
+                os.rename(self.fileName+'.tmp',self.fileName)
+            tracer.log('collector',TraceLevel.INFO,"Path collection ended, %d paths written to %s",self.pathCount,self.fileName)
+            if self.notify:
+                self.notify('Paths written to %s' % self.fileName)
+        else:
+            for f in self.openPaths.values():
+                f.close()
+            self.svg.close()
+            os.remove(self.fileName+'.tmp')
+        return False
+
+    # Overloaded to create the initial paths
+    def startPaths(self):
+        pass
+
+    def openPath(self,name):
+        self.openPaths[name]=tempfile.TemporaryFile()
+
+    def closePath(self,name):
+        data=self.openPaths.pop(name)
+        if data.tell(): # Empty paths are not written
+            data.seek(0)
+            self.pathCount+=1
+            self.svg.write(toBytes('<path id="ofn-path-%d" fill="none" stroke="black" d="' % self.pathCount))
+            shutil.copyfileobj(data,self.svg)
+            self.svg.write(b'"><title>'+toBytes(escape(name))+b'</title></path>\n')
+        data.close()
+
+    def writeMovedPath(self,strokes,name,cX,cY,pX,pY,tilt):
+        placement=self.placement(cX,cY,pX,pY,tilt)
+        data=self.openPaths[name]
+        for points,closed in self.moveOutline(strokes,placement):
+            data.write(toBytes(svgPathData(points,closed)))
+
+class SVGOnePathToRuleThemAll(SVGCollector):
+    def startPaths(self):
+        self.openPath(self.pathName)
+        if self.showBoxes:
+            self.openPath('Boxes for '+self.pathName)
+
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.writeMovedPath(cStrokes,self.pathName,cX,cY,pX,pY,tilt)
+
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
+        if self.showBoxes:
+            self.writeMovedPath(bStrokes,'Boxes for '+self.pathName,cX,cY,pX,pY,tilt)
+
+class SVGOnePathPerStroke(SVGCollector):
+    def enterStroke(self,strokeIndex):
+        for name in list(self.openPaths):
+            self.closePath(name)
+        self.strokeName='%s[%02d]' % (self.pathName,strokeIndex)
+        self.openPath(self.strokeName)
+        if self.showBoxes:
+            self.openPath('Boxes for '+self.strokeName)
+
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.writeMovedPath(cStrokes,self.strokeName,cX,cY,pX,pY,tilt)
+
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
+        if self.showBoxes:
+            self.writeMovedPath(bStrokes,'Boxes for '+self.strokeName,cX,cY,pX,pY,tilt)
+
+class SVGTextAndSpacer(SVGCollector):
+    def startPaths(self):
+        self.cNames=['Text for %s' % self.pathName,'Spacer for %s' % self.pathName]
+        self.bNames=['Text boxes for %s' % self.pathName,'Spacer boxes for %s' % self.pathName]
+        for name in self.cNames+(self.bNames if self.showBoxes else []):
+            self.openPath(name)
+
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.writeMovedPath(cStrokes,self.cNames[cType],cX,cY,pX,pY,tilt)
+
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
+        if self.showBoxes:
+            self.writeMovedPath(bStrokes,self.bNames[cType],cX,cY,pX,pY,tilt)
+
+class SVGEachOnItsOwn(SVGCollector):
+    def enterStroke(self,strokeIndex):
+        self.strokeName='%s[%02d]' % (self.pathName,strokeIndex)
+
+    def enterCharacter(self,charIndex,char):
+        for name in list(self.openPaths):
+            self.closePath(name)
+        self.charName=u'%s[%02d][%s]' % (self.strokeName,charIndex,toUnicode(char))
+        self.openPath(self.charName)
+
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.writeMovedPath(cStrokes,self.charName,cX,cY,pX,pY,tilt)
+
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
+        if self.showBoxes:
+            self.writeMovedPath(bStrokes,self.charName,cX,cY,pX,pY,tilt)
+
+#----------------------------------------------------
+# Outline: strokes kept in compact form, the coordinates of all strokes
+# end to end in a single array, with the start of each stroke (plus the
+# end of the last one) and its closed flag. Built once per glyph, so the
+# placement of the characters only works on this in-process data.
+# Iterating gives the usual (points,closed) tuples.
+#----------------------------------------------------
+class Outline(object):
+    __slots__=('coords','starts','closed')
+
+    def __init__(self,strokes=()):
+        self.coords=array('d')
+        self.starts=array('l',[0])
+        self.closed=array('B')
+        for points,closed in strokes:
+            self.coords.extend(points)
+            self.starts.append(len(self.coords))
+            self.closed.append(bool(closed))
+
+    def __len__(self):
+        return len(self.closed)
+
+    def __iter__(self):
+        starts=self.starts
+        for i,closed in enumerate(self.closed):
+            yield self.coords[starts[i]:starts[i+1]],bool(closed)
+
+#----------------------------------------------------
+# Glyph: the outline of a character (strokes, box, sizes),
+# built once and shared by all its occurrences in the text.
+# Blank characters have no strokes.
+#----------------------------------------------------
+class Glyph(object):
+    __slots__=('character','width','height','strokes','boxStrokes','marginL','marginR')
+
+    def __init__(self,character,width,height):
+        self.character=character
+        self.width=width
+        self.height=height
+        self.strokes=None
+        self.boxStrokes=None
+        self.marginL=0
+        self.marginR=0
+
+#----------------------------------------------------
+# Character in text: a glyph, with the kerning with
+# the previous character. Shared by all its placements.
+#----------------------------------------------------
+CTYPE_TEXT=0
+CTYPE_JOIN=1
+
+class Character(object):
+    __slots__=('glyph','kerning','ctype')
+
+    def __init__(self,glyph,ctype):
+        self.glyph=glyph
+        self.kerning=0 # Normally negative when characters are squeezed (AV, XO)
+        self.ctype=ctype
+
+    # Shared glyph data
+    character=property(lambda self: self.glyph.character)
+    width=property(lambda self: self.glyph.width)
+    height=property(lambda self: self.glyph.height)
+    strokes=property(lambda self: self.glyph.strokes)
+    boxStrokes=property(lambda self: self.glyph.boxStrokes)
+    marginL=property(lambda self: self.glyph.marginL)
+    marginR=property(lambda self: self.glyph.marginR)
+
+    def __str__(self):
+        if self.strokes:
+            return "<'%s' (%d,%d), [%s], %d stroke(s)>" % (self.character,self.width,self.height,"TS"[self.ctype],len(self.strokes))
+        else:
+            return "<'%s' (%d,%d), [%s], (no path)>" % (self.character,self.width,self.height,"TS"[self.ctype])
+
+    def __repr__(self):
+        return str(self)
+
+    def dumpPath(self):
+        if self.strokes:
+           dumpStrokes(self.strokes)
+
+#----------------------------------------------------
+# Sequence of characters laid out on a stroke: the first
+# characters, followed by a number of repeats of a unit.
+# The indices of the characters are only generated when
+# iterated, so a long repeated text isn't built in memory.
+#----------------------------------------------------
+class CharacterSequence(object):
+    __slots__=('characters','first','more','repeat')
+
+    def __init__(self,characters,first,more=(),repeat=0):
+        self.characters=characters
+        self.first=first
+        self.more=more
+        self.repeat=repeat
+
+    def __len__(self):
+        return len(self.first)+len(self.more)*self.repeat
+
+    def indices(self):
+        return itertools.chain(self.first,itertools.chain.from_iterable(itertools.repeat(self.more,self.repeat)))
+
+#----------------------------------------------------
+# Placements: a chunk of the characters laid out on a stroke,
+# kept as a table with one array per column. The characters
+# are shared, each placement is only the index of its
+# character, its position along the stroke and, once moved
+# to the stroke, its final X, Y and tilt. So repeating a text
+# on a long stroke costs a few numbers per placement.
+#----------------------------------------------------
+class Placements(object):
+    __slots__=('characters','indices','positions','xs','ys','tilts')
+
+    def __init__(self,characters,indices):
+        self.characters=characters
+        self.indices=indices
+        self.positions=array('d')
+        self.xs=array('d')
+        self.ys=array('d')
+        self.tilts=array('d')
+
+    def __len__(self):
+        return len(self.indices)
+
+    # The characters, in placement order
+    def __iter__(self):
+        characters=self.characters
+        for i in self.indices:
+            yield characters[i]
+
+#----------------------------------------------------
+# Ink clusters of a rendered text, for word rendering: the
+# strokes sorted by their left end, a stroke being added to the
+# previous cluster when they overlap horizontally on more than
+# half of the narrower of the two (holes, accents, dots of "i",
+# but not kerned pairs such as "AV"). Returns a list of
+# (left,right,strokes) tuples.
+#----------------------------------------------------
+def inkClusters(strokes):
+    clusters=[]
+    for left,right,stroke in sorted([(min(points[0::2]),max(points[0::2]),(points,closed)) for points,closed in strokes],
+                                    key=lambda s: s[0]):
+        if clusters:
+            cLeft,cRight,cStrokes=clusters[-1]
+            if min(right,cRight)-max(left,cLeft)>min(right-left,cRight-cLeft)/2.:
+                clusters[-1]=(cLeft,max(right,cRight),cStrokes+[stroke])
+                continue
+        clusters.append((left,right,[stroke]))
+    return clusters
+
+#----------------------------------------------------
+# Text to work on
+#----------------------------------------------------
+class Formatter(object):
+
+    def __init__(self,text,joiner,glyphProvider,
+            layout=Layout.CENTER, useKerning=True, extraSpacing=0,
+            pivotYChoice=Pivot.BASELINE, verticalAdjust=0,
+            keepUpright=False,wiggleXPercent=0, wiggleYPercent=0, wiggleTheta=0,
+            wordRender=False, wiggleSeed=0):
+        self.glyphProvider=glyphProvider
+        self.layout=layout
+        self.useKerning=useKerning
+        self.extraSpacing=extraSpacing
+        self.pivotYChoice=pivotYChoice
+        self.verticalAdjust=verticalAdjust
+        self.keepUpright=keepUpright
+        self.wiggleXPercent=wiggleXPercent
+        self.wiggleYPercent=wiggleYPercent
+        self.wiggleTheta=wiggleTheta
+        self.wiggles=bool(wiggleXPercent or wiggleYPercent or wiggleTheta)
+        # Seed 0 is a new random seed on each run, traced so that the run can be reproduced
+        self.wiggleSeed=wiggleSeed or random.randint(1,2**31-1)
+        if self.wiggles:
+            tracer.log('layout',TraceLevel.INFO,'Wiggle seed: %d',self.wiggleSeed)
+        self.wordRender=wordRender
+
+        self.pivotY=None
+        self.glyphs={} # character -> Glyph
+        self.textCharacters=[]
+        self.joinCharacters=[]
+        with profiler.phase('pivot'):
+            self.computePivotY()
+        self.setText(text,joiner)
+
+    # Set the text to lay out. The font state (pivot, glyphs) is kept,
+    # so glyphs built for a previous text are reused.
+    def setText(self,text,joiner):
+        self.text=list(toUnicode(text))
+        self.joiner=list(toUnicode(joiner))
+        self.initializeCharacters()
+
+    def extents(self,text):
+        ext=self.glyphProvider.extents(text)
+        #trace('font',"extents[w](%s)=%3.2f",text,ext[0])
+        return ext
+
+    def boxStrokes(self,w,h):
+        w,h=float(w),float(h)
+        return Outline([([0.,0.]*3+[w,0.]*3+[w,h]*3+[0.,h]*3,True)])
+
+    def setOutline(self,glyph,strokes):
+        glyph.strokes=Outline(strokes)
+        glyph.boxStrokes=self.boxStrokes(glyph.width,glyph.height)
+        # compute margins
+        allX=glyph.strokes.coords[0::2]
+        glyph.marginL=min(allX)
+        glyph.marginR=glyph.width-max(allX)
+
+    def createGlyph(self,c):
+        if self.wordRender: # Only the metrics, the outline comes from the whole text
+            cw,ch,_,_=self.extents(c)
+            return Glyph(c,cw,ch)
+        cw,ch,strokes=self.glyphProvider.glyph(c)
+        glyph=Glyph(c,cw,ch)
+        if c not in blankCharacters:
+            self.setOutline(glyph,strokes)
+        return glyph
+
+    # Glyphs are built on first use, so repeated characters are rendered only once
+    def getGlyph(self,c):
+        glyph=self.glyphs.get(c)
+        if not glyph:
+            with profiler.phase('glyphs'):
+                glyph=self.glyphs[c]=self.createGlyph(c)
+        return glyph
+
+    # Kerning is the difference between width of the pair with kerning (pw)
+    # and the sum of the individual character widths (can be negative: "AV")
+    def pairKerning(self,k,c):
+        cw=self.getGlyph(c).width
+        kw=self.getGlyph(k).width
+        with profiler.phase('kerning'):
+            pw,_,_,_=self.extents(k+c)
+        kerning=pw-(cw+kw)
+        if tracer.active:
+            trace('kerning','Kerning %c -> %c: %3.2f - (%3.2f + %3.2f) = %3.2f',k,c,pw,cw,kw,kerning)
+        return kerning
+
+    def createCharacter(self,c,k,ctype):
+        char=Character(self.getGlyph(c),ctype)
+
+        # compute kerning if necessary
+        if k and self.useKerning:
+            char.kerning=self.pairKerning(k,c)
+        return char
+
+    # Word rendering: the whole text is rendered once, and split in
+    # characters. Each character gets its own glyph, so the shaping of the
+    # text (contextual forms) is kept.
+    #
+    # When the strokes make one cluster per non-blank character (see
+    # inkClusters()), each cluster goes to its character, and characters
+    # are delimited in the middle of the gaps between clusters (blank
+    # characters take their own width in the gap): advances, kerning and
+    # margins are those of the rendered text, and the metrics calls don't
+    # depend on the length of the text. Otherwise (ligatures, characters
+    # with separate parts such as quotes), or without kerning, see
+    # splitOutline().
+    def wordCharacters(self,text,kerningCharacters,ctype):
+        strokes=[]
+        if any(c not in blankCharacters for c in text):
+            strokes=self.glyphProvider.textOutline(''.join(text))
+        characters=self.shapedCharacters(text,strokes,ctype) if self.useKerning else None
+        if characters:
+            # Texts are rendered separately, kerning with the previous text is added
+            characters[0].kerning=self.pairKerning(kerningCharacters[0],text[0])
+        else:
+            characters=[self.createCharacter(c,k,ctype) for c,k in zip(text,kerningCharacters)]
+            self.splitOutline(text,characters,strokes)
+        return characters
+
+    def shapedCharacters(self,text,strokes,ctype):
+        inked=[i for i,c in enumerate(text) if c not in blankCharacters]
+        clusters=inkClusters(strokes)
+        if len(clusters)!=len(inked):
+            trace('font','Word rendering of "%s": %d clusters for %d characters, using character metrics',''.join(text),len(clusters),len(inked))
+            return None
+        width,height,_,_=self.extents(''.join(text))
+        blankWidths=dict((i,self.getGlyph(c).width) for i,c in enumerate(text) if c in blankCharacters)
+        # Limits of the characters, from the gaps around the clusters (the first
+        # gap starts at the pen origin and the last one ends at the text width)
+        limits=[0.]*(len(text)+1)
+        starts=[0]+[i+1 for i in inked]
+        ends=inked+[len(text)]
+        lefts=[0.]+[x1 for _,x1,_ in clusters]
+        rights=[x0 for x0,_,_ in clusters]+[width]
+        for gap,(start,end,left,right) in enumerate(zip(starts,ends,lefts,rights)):
+            free=right-left-sum(blankWidths[i] for i in range(start,end))
+            x=left+(0. if gap==0 else free if gap==len(inked) else free/2.)
+            limits[start]=x
+            for i in range(start,end):
+                x+=blankWidths[i]
+                limits[i+1]=x
+        characters=[]
+        clusterStrokes=dict((i,cluster[2]) for i,cluster in zip(inked,clusters))
+        for i,c in enumerate(text):
+            glyph=Glyph(c,limits[i+1]-limits[i],height)
+            if i in clusterStrokes:
+                moved=[]
+                for points,closed in clusterStrokes[i]:
+                    points=list(points)
+                    points[0::2]=[x-limits[i] for x in points[0::2]]
+                    moved.append((points,closed))
+                self.setOutline(glyph,moved)
+            characters.append(Character(glyph,ctype))
+        return characters
+
+    # Word rendering fallback: the characters are placed at their pen
+    # position computed from the character widths and kerning pairs, and
+    # the strokes are given to the character whose box contains their
+    # middle. A character that gets no strokes (blank, or merged in a
+    # ligature) has no path.
+    def splitOutline(self,text,characters,strokes):
+        pens=[0.]
+        for i in range(1,len(characters)):
+            kerning=characters[i].kerning if self.useKerning else self.pairKerning(text[i-1],text[i])
+            pens.append(pens[-1]+characters[i-1].width+kerning)
+        charStrokes=[[] for _ in characters]
+        for points,closed in strokes:
+            xs=points[0::2]
+            i=max(0,bisect.bisect_right(pens,(min(xs)+max(xs))/2.)-1)
+            moved=list(points)
+            moved[0::2]=[x-pens[i] for x in xs]
+            charStrokes[i].append((moved,closed))
+        for char,strokes in zip(characters,charStrokes):
+            glyph=Glyph(char.character,char.width,char.height)
+            if strokes:
+                self.setOutline(glyph,strokes)
+            char.glyph=glyph
+
+    def createCharacters(self,text,kerningCharacters,ctype):
+        if self.wordRender:
+            with profiler.phase('glyphs'):
+                return self.wordCharacters(text,kerningCharacters,ctype)
+        return [self.createCharacter(c,k,ctype) for c,k in zip(text,kerningCharacters)]
+
+    def initializeCharacters(self):
+        trace('layout',lambda: 'Text: %s, Joiner: %s' % (''.join(self.text),''.join(self.joiner)))
+        # To compute kerning a character needs to know the character on its right
+        # For the first character of the text this is the last character of the text or the joiner
+        # Kerning for 1st character is always computed even if its not used on open strokes
+        firstKerning=self.joiner[-1] if self.joiner and self.layout==Layout.REPEAT else self.text[-1]
+        kerningCharacters=[firstKerning]+self.text[:-1]
+        self.textCharacters=self.createCharacters(self.text,kerningCharacters,CTYPE_TEXT)
+
+        self.joinCharacters=[]
+        if self.joiner:
+        # For the first character of the joiner this is the last character of the text
+            firstKerning=self.text[-1]
+            kerningCharacters=[firstKerning]+self.joiner[:-1]
+            self.joinCharacters=self.createCharacters(self.joiner,kerningCharacters,CTYPE_JOIN)
+
+    # Compute offsets for pivot point Y. Since there is no API to obtain geometry information
+    # for the font, some guesswork is required. We will assume that 'X' and 'x' are fairly symmetrical
+    # and that their topmost point is as much above the line of upper/lowercase tops than their lowest point
+    # is below the baseline (except for very round fonts this will be 0).
+
+    def verticalSpread(self,text,ascent):
+        # Gather all Y values (anchors and handles) in all strokes of the sample text for the bounding box
+        allY=[y for points,_ in self.glyphProvider.textOutline(text) for y in points[1::2]]
+        minY=min(allY)
+        maxY=max(allY)
+        top=minY+(maxY-ascent)
+        middle=(minY+maxY)/2.
+        return top,middle
+
+    def computePivotY(self):
+
+        width,height,ascent,descent=self.extents('X')
+        trace('layout',
+'''
+==================
+Width:     %7.2f
+Height:    %7.2f
+Ascent:    %7.2f
+Descent:   %7.2f
+------------------
+''',width,height,ascent,descent)
+        self.wiggleYMax=height
+
+        # compute all possible pivotY and keep the good one (easier to debug)
+        pivot=[0 for _ in Pivot.labels] # Array of same size as choices
+        pivot[Pivot.BASELINE]=ascent
+        pivot[Pivot.TOP]=0
+        pivot[Pivot.BOTTOM]=height
+        pivot[Pivot.BOXMIDDLE]=height/2.
+        pivot[Pivot.UCTOP],pivot[Pivot.UCMIDDLE]=self.verticalSpread('X',ascent)
+        pivot[Pivot.LCTOP],pivot[Pivot.LCMIDDLE]=self.verticalSpread('x',ascent)
+
+        trace('layout',
+'''
+Baseline:  %7.2f
+Top:       %7.2f
+Bottom:    %7.2f
+MiddleBox: %7.2f
+TopUC:     %7.2f
+MiddleUC:  %7.2f
+TopLC:     %7.2f
+MiddleLC:  %7.2f
+''',*pivot)
+        self.pivotY=pivot[self.pivotYChoice]+self.verticalAdjust
+
+    # Functions to compute how to layout the characters on the stroke
+    # Return:
+    #  - actual character sequence (CharacterSequence)
+    #  - actual extra spacing
+    #  - total string width
+
+    def checkFit(self,textWidth,strokeLength):
+         if textWidth > strokeLength:
+            raise Exception('Text width (%3.2f) larger than path stroke length (%3.2f)' % (textWidth,strokeLength))
+
+    def firstTextWidth(self,characters):
+        rawTextWidth=sum([c.width+c.kerning for c in characters])
+        rawTextWidth-=characters[0].kerning # No kerning on 1st
+        rawTextWidth-=characters[0].marginL+characters[-1].marginR # Exclude margins
+        return rawTextWidth
+
+    # The text characters, once each
+    def textSequence(self):
+        return CharacterSequence(self.textCharacters,range(len(self.textCharacters)))
+
+    def plainTextWidth(self,characters):
+        rawTextWidth=self.firstTextWidth(characters)
+        intervals=len(characters)-1
+        textWidth=rawTextWidth+self.extraSpacing*intervals
+        return textWidth
+
+    # LEFT, RIGHT, CENTERED
+    # Just check fit on stroke, kerning of 1st char is not used
+
+    def layoutLeft(self,stroke):
+        textWidth=self.plainTextWidth(self.textCharacters)
+        self.checkFit(textWidth,stroke.length)
+        # compensate for left margin if necessary
+        offset=-self.textCharacters[0].marginL
+        return self.textSequence(),self.extraSpacing,textWidth,offset
+
+    def layoutRight(self,stroke):
+        textWidth=self.plainTextWidth(self.textCharacters)
+        self.checkFit(textWidth,stroke.length)
+        # compensate for right margin if necessary
+        offset=stroke.length-(textWidth+self.textCharacters[0].marginL)
+        return self.textSequence(),self.extraSpacing,textWidth,offset
+
+    def layoutCenter(self,stroke):
+        textWidth=self.plainTextWidth(self.textCharacters)
+        self.checkFit(textWidth,stroke.length)
+        offset=((stroke.length-textWidth)/2.)-self.textCharacters[0].marginL
+        return self.textSequence(),self.extraSpacing,textWidth,offset
+
+    # FILLED
+    def layoutFilled(self,stroke):
+        # String always fits even if it requires to collapse everything.
+        # Might creash is path shorter that one character width
+        if stroke.closed:
+            # last char abutted on first, so kerning counts and #intervals=#chars
+            # However the margins are always used (all characters have neighbors on both sides)
+            textWidth=sum([c.width+c.kerning for c in self.textCharacters])
+            intervals=len(self.textCharacters)
+        else:
+            # no kerning on 1st, and one less intervals, consider margins
+            textWidth=self.plainTextWidth(self.textCharacters)
+            intervals=len(self.textCharacters)-1
+        offset=-self.textCharacters[0].marginL
+        return self.textSequence(),(stroke.length-textWidth)/intervals,stroke.length,offset
+
+    # REPEATED
+    def layoutRepeated(self,stroke):
+        if stroke.closed:
+            return self.layoutRepeatedOnClosed(stroke)
+        else:
+            return self.layoutRepeatedOnOpen(stroke)
+
+    def layoutRepeatedOnClosed(self,stroke):
+        # joiner always used
+        # kerning on 1st included, margins included
+        textUnit=self.textCharacters+self.joinCharacters
+        rawTextUnitWidth=sum([c.width+c.kerning for c in textUnit])
+        textUnitWidth=rawTextUnitWidth+(self.extraSpacing*len(textUnit))
+        # Check we can at least fit one
+        self.checkFit(textUnitWidth,stroke.length)
+        repeat=int(stroke.length/textUnitWidth)
+        # The unit characters are shared by all the repeats
+        sequence=CharacterSequence(textUnit,(),range(len(textUnit)),repeat)
+        rawFullTextLength=rawTextUnitWidth*repeat
+        actualSpacing=(stroke.length-rawFullTextLength)/len(sequence)
+        trace('layout',"Stroke: %3.2f, Unit: %3.2f, Repeat: %d, Full: %3.2f, actualSpacing: %3.2f",
+               stroke.length,textUnitWidth,repeat,rawFullTextLength,actualSpacing)
+        offset=-textUnit[0].marginL
+        return sequence, actualSpacing,stroke.length,offset
+
+    def layoutRepeatedOnOpen(self,stroke):
+        # joiner not used if we can only fit one copy
+        textFirstUnit=self.textCharacters
+        rawTextFirstUnitWidth=self.firstTextWidth(textFirstUnit)
+        textFirstUnitWidth=rawTextFirstUnitWidth+(self.extraSpacing*(len(textFirstUnit)-1))
+        # Check we can at least fit one
+        self.checkFit(textFirstUnitWidth,stroke.length)
+        # Addional repeats: always joiner+text, first character has kerning
+        # And as many intervals as characters
+        textMoreUnit=self.joinCharacters+self.textCharacters
+        rawTextMoreUnitWidth=sum([c.width+c.kerning for c in textMoreUnit])
+        textMoreUnitWidth=rawTextMoreUnitWidth+(self.extraSpacing*len(textMoreUnit))
+        repeat=int((stroke.length-textFirstUnitWidth)/textMoreUnitWidth)
+        # Text and joiner characters are shared by all the repeats: the joiner characters
+        # are after the text ones, and the additional repeats start with the joiner
+        firstIndices=list(range(len(textFirstUnit)))
+        moreIndices=list(range(len(textFirstUnit),len(textFirstUnit)+len(self.joinCharacters)))+firstIndices
+        sequence=CharacterSequence(textFirstUnit+self.joinCharacters,firstIndices,moreIndices,repeat)
+        rawFullTextLength=rawTextFirstUnitWidth+(rawTextMoreUnitWidth*repeat)
+        actualSpacing=(stroke.length-rawFullTextLength)/(len(sequence)-1)
+        trace('layout',"Stroke: %3.2f, First: %3.2f, More: %3.2f, Repeat: %d, Full: %3.2f, actualSpacing: %3.2f",
+               stroke.length,textFirstUnitWidth,textMoreUnitWidth,repeat,rawFullTextLength,actualSpacing)
+        offset=-textFirstUnit[0].marginL
+        return sequence, actualSpacing,stroke.length,offset
+
+    # Lay out the characters on the stroke. This only checks the fit and
+    # computes the character sequence and spacing, the positions of the
+    # characters are computed when they are moved to the stroke.
+    #
+    # The wiggle of each stroke comes from its own generator, seeded from
+    # the wiggle seed and the stroke index (1 for the first stroke), so a
+    # non-zero seed always gives the same result, even when the strokes are
+    # laid out in parallel.
+    def layoutOnStroke(self,stroke,strokeIndex=1):
+        if self.wiggles:
+            self.wiggleRandom=random.Random(self.wiggleSeed*65536+strokeIndex)
+        with profiler.phase('layout'):
+            layoutFunction=[self.layoutLeft,self.layoutRight,self.layoutCenter,self.layoutFilled,self.layoutRepeated]
+            self.sequence,self.actualSpacing,textWidth,self.startOffset=layoutFunction[self.layout](stroke)
+
+            self.wiggleXMax=textWidth/len(self.sequence)
+
+            trace('layout','Stroke length: %3.2f, start offset: %3.2f, actualSpacing: %3.2f, actual text width: %3.2f, characters: %d',
+                  stroke.length,self.startOffset,self.actualSpacing,textWidth,len(self.sequence))
+
+    #----------------------------------------------------
+    # Placement pipeline
+    #
+    # The characters of the sequence go through a chain of generators,
+    # by chunks of placementChunk characters: positions along the stroke,
+    # then stroke points and final position, then output to the path
+    # collector. Only one chunk is in memory at a time, and the first
+    # characters are output before the end of the stroke is laid out.
+    #----------------------------------------------------
+    placementChunk=int(os.getenv('OFN_TEXT_ALONG_PATH_CHUNK',256))
+
+    # Positions along the stroke (actually position of Pivot/Center of character)
+    def positionedChunks(self):
+        characters=self.sequence.characters
+        indices=self.sequence.indices()
+        offset=self.startOffset
+        while True:
+            with profiler.phase('layout'):
+                chunk=Placements(characters,array('l',itertools.islice(indices,self.placementChunk)))
+                positions=chunk.positions
+                for c in chunk:
+                    position=offset+c.width/2.+c.kerning
+                    offset=position+c.width/2.+self.actualSpacing
+                    positions.append(position)
+                    if tracer.active:
+                        trace('layout','%s @%3.2f',c,position)
+            if not len(chunk):
+                return
+            yield chunk
+
+    # Stroke points at the positions (all points of a chunk obtained at once),
+    # and final position of the characters
+    def movedChunks(self,stroke,chunks):
+        for chunk in chunks:
+            with profiler.phase('placement'):
+                xs,ys,slopes=stroke.getPointsAtDists(chunk.positions)
+                chunk.xs,chunk.ys,chunk.tilts=self.finalPositions(xs,ys,slopes)
+                if tracer.active:
+                    for position,x,y in zip(chunk.positions,chunk.xs,chunk.ys):
+                        trace('layout',"%3.2f moved to %3.2f,%3.2f",position,x,y)
+            yield chunk
+
+    # Final positions of characters, from the stroke points at their positions,
+    # computed for a whole chunk at once. Without wiggle, the stroke points are
+    # used as is. The wiggle values are drawn in character order (X, Y and tilt
+    # for each character), so they don't depend on the chunk size.
+    def finalPositions(self,xs,ys,slopes):
+        if self.keepUpright:
+            tilts=array('d',[0.])*len(slopes)
+        else:
+            tilts=array('d',[slope*180/math.pi for slope in slopes])
+        if not self.wiggles:
+            return array('d',xs),array('d',ys),tilts
+
+        wiggleXRange=self.wiggleXMax*self.wiggleXPercent/100.
+        wiggleYRange=self.wiggleYMax*self.wiggleYPercent/100.
+        uniform=self.wiggleRandom.uniform
+        wiggles=[(uniform(-wiggleXRange,wiggleXRange),uniform(-wiggleYRange,wiggleYRange),uniform(-self.wiggleTheta,self.wiggleTheta))
+                 for _ in slopes]
+        coss=[math.cos(slope) for slope in slopes]
+        sins=[math.sin(slope) for slope in slopes]
+        wxs,wys,wtilts=zip(*wiggles)
+        return (array('d',[x+wx*cos-wy*sin for x,wx,wy,cos,sin in zip(xs,wxs,wys,coss,sins)]),
+                array('d',[y+wy*cos+wx*sin for y,wx,wy,cos,sin in zip(ys,wxs,wys,coss,sins)]),
+                array('d',[tilt+wtilt for tilt,wtilt in zip(tilts,wtilts)]))
+
+    def moveCharacterToStroke(self,c,x,y,tilt,pathCollector):
+        # Position of NW corner of character box
+        cX=x-c.width/2.
+        cY=y-self.pivotY
+        # Position of pivot in box
+        pX=c.width/2.
+        pY=self.pivotY
+        pathCollector.addCharacter(c.strokes,cX,cY,pX,pY,tilt,c.ctype)
+        pathCollector.addBox(c.boxStrokes,cX,cY,pX,pY,tilt,c.ctype)
+
+    # Output of the moved characters to the path collector
+    def emitChunks(self,chunks,pathCollector):
+        i=0
+        for chunk in chunks:
+            with profiler.phase('placement'):
+                for c,x,y,tilt in zip(chunk,chunk.xs,chunk.ys,chunk.tilts):
+                    i+=1
+                    pathCollector.enterCharacter(i,c.character)
+                    if c.strokes: # nothing to do on blank characters
+                        self.moveCharacterToStroke(c,x,y,tilt,pathCollector)
+
+    def moveCharactersToStroke(self,stroke,pathCollector):
+        trace('layout',"Max wiggle X,Y: %3.2f,%3.2f",self.wiggleXMax,self.wiggleYMax)
+        self.emitChunks(self.movedChunks(stroke,self.positionedChunks()),pathCollector)
+
+    # Layout of a stroke as plain data, for the parallel layout: the stroke
+    # points and its length table (None if not known yet) in, the length
+    # table and the placements (character indices, final X, Y and tilt) out.
+    # The indices are those of the text characters followed by the joiner
+    # characters, as in all the character sequences.
+    def layoutStrokeData(self,strokeIndex,points,closed,backwards,table):
+        strokeTable=StrokeTable(table)
+        stroke=DirectionStroke(Stroke(points,closed),backwards,strokeTable)
+        self.layoutOnStroke(stroke,strokeIndex)
+        indices,xs,ys,tilts=array('l'),array('d'),array('d'),array('d')
+        for chunk in self.movedChunks(stroke,self.positionedChunks()):
+            indices.extend(chunk.indices)
+            xs.extend(chunk.xs)
+            ys.extend(chunk.ys)
+            tilts.extend(chunk.tilts)
+        return strokeTable.table,indices,xs,ys,tilts
+
+#----------------------------------------------------
+# Parallel layout
+#
+# The layout of a stroke doesn't depend on the other strokes, so
+# on paths with many strokes the strokes can be laid out in a pool of
+# processes. This is only worth it for long texts on many strokes,
+# so it is off by default: OFN_TEXT_ALONG_PATH_PARALLEL sets the
+# minimum number of strokes (0, the default, disables it). The
+# workers are forked and given the formatter (and its glyphs) by
+# the pool initializer, and only plain data is exchanged: the stroke
+# points in, the placements and length tables out. The output to
+# the path collector stays in the calling process. Where processes
+# can't be forked, or on a single CPU, there is no pool, and the
+# strokes are laid out in the calling process as usual.
+#----------------------------------------------------
+
+# Geometry cache of a single stroke, to give a worker the known length
+# table of its stroke, and get back the one it builds
+class StrokeTable(object):
+    def __init__(self,table):
+        self.table=table
+
+    def get(self,points,closed,tolerance):
+        return self.table
+
+    def put(self,points,closed,tolerance,dists,params):
+        self.table=(dists,params)
+
+workerFormatter=None # Set in each worker by the pool initializer
+
+def initializeWorker(formatter):
+    global workerFormatter
+    workerFormatter=formatter
+
+def layoutStrokeJob(job):
+    return workerFormatter.layoutStrokeData(*job)
+
+class ParallelLayout(object):
+    minStrokes=int(os.getenv('OFN_TEXT_ALONG_PATH_PARALLEL',0))
+
+    def __init__(self,formatter,strokeCount):
+        self.formatter=formatter
+        self.pool=None
+        if not (multiprocessing and hasattr(os,'fork') and self.minStrokes and strokeCount>=self.minStrokes):
+            return
+        try:
+            processes=min(multiprocessing.cpu_count(),strokeCount)
+            if processes>1:
+                # Forked explicitly, since it's no longer the default everywhere in Python 3
+                context=multiprocessing.get_context('fork') if hasattr(multiprocessing,'get_context') else multiprocessing
+                self.pool=context.Pool(processes,initializeWorker,(formatter,))
+                tracer.log('layout',TraceLevel.INFO,'Parallel layout of %d strokes with %d processes',strokeCount,processes)
+        except (OSError,ValueError,NotImplementedError) as e:
+            tracer.log('layout',TraceLevel.WARNING,'No parallel layout: %s',e)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type, exc_val, exc_tb):
+        if self.pool:
+            if exc_type:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+        return False
+
+    # Placements of the strokes, given as (points,closed) tuples, in stroke
+    # order, so the output of the first strokes can start while the next
+    # ones are laid out.
+    def placements(self,strokes,backwards,geometryCache=None):
+        tolerance=DirectionStroke.tolerance
+        tables=[geometryCache.get(points,closed,tolerance) if geometryCache else None for points,closed in strokes]
+        results=self.pool.imap(layoutStrokeJob,[(i,points,closed,backwards,table) for i,((points,closed),table) in enumerate(zip(strokes,tables),1)])
+        characters=self.formatter.textCharacters+self.formatter.joinCharacters
+        for (points,closed),knownTable in zip(strokes,tables):
+            with profiler.phase('layout'):
+                table,indices,xs,ys,tilts=next(results)
+                if geometryCache and not knownTable:
+                    geometryCache.put(points,closed,tolerance,*table)
+                placements=Placements(characters,indices)
+                placements.xs,placements.ys,placements.tilts=xs,ys,tilts
+            yield placements
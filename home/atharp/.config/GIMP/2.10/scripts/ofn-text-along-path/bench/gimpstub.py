@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# In-memory stand-in for gimpfu, to run ofn-text-along-path outside of Gimp.
+#
+# Only what the plugin uses is implemented. Every call that would be a PDB
+# call (procedure, or attribute access going through the PDB in the real
+# gimpfu) is counted in "calls", and can be given a latency (in seconds)
+# to model the round-trip between the plugin and Gimp.
+#
+# The font is synthetic: character widths depend on the character code,
+# a few pairs are kerned, and each glyph is a closed stroke of four anchors
+# with one curved side.
+
+import math, time
+
+RGB, GRAY, INDEXED = 0, 1, 2
+PIXELS = 0
+PARASITE_PERSISTENT = 1
+(PF_IMAGE, PF_VECTORS, PF_STRING, PF_TEXT, PF_FONT, PF_SPINNER, PF_OPTION,
+ PF_TOGGLE, PF_FLOAT, PF_INT, PF_FILE, PF_FILENAME, PF_DIRNAME, PF_BOOL) = range(14)
+
+# What "from gimpfu import *" provides
+__all__=['gimp','pdb','register','main','RGB','GRAY','INDEXED','PIXELS','PARASITE_PERSISTENT',
+         'PF_IMAGE','PF_VECTORS','PF_STRING','PF_TEXT','PF_FONT','PF_SPINNER','PF_OPTION',
+         'PF_TOGGLE','PF_FLOAT','PF_INT','PF_FILE','PF_FILENAME','PF_DIRNAME','PF_BOOL']
+
+calls={}      # procedure name -> number of calls
+latency=0.    # added to each call
+messages=[]   # gimp_message() output
+
+def call(name):
+    calls[name]=calls.get(name,0)+1
+    if latency:
+        time.sleep(latency)
+
+def resetCalls():
+    calls.clear()
+    del messages[:]
+
+# Attribute that is a PDB call in the real gimpfu
+def pdbProperty(name,procedure):
+    def get(self):
+        call(procedure)
+        return getattr(self,name)
+    def set(self,value):
+        call(procedure.replace('_get_','_set_'))
+        setattr(self,name,value)
+    return property(get,set)
+
+#----------------------------------------------------
+# Synthetic font
+#----------------------------------------------------
+kerningPairs={'AV':-.12,'VA':-.12,'To':-.1,'Te':-.08,'LT':-.1,'Yo':-.1,'ov':-.02}
+
+def charWidth(c,size):
+    return size*(.35+.05*(ord(c)%8))
+
+def textExtents(text,size):
+    width=sum(charWidth(c,size) for c in text)
+    for a,b in zip(text,text[1:]):
+        width+=kerningPairs.get(a+b,0.)*size
+    return width,size*1.2,size*.95,size*.25
+
+def textStrokes(text,size):
+    strokes=[]
+    x=0.
+    previous=None
+    for c in text:
+        if previous is not None:
+            x+=kerningPairs.get(previous+c,0.)*size
+        w=charWidth(c,size)
+        if c!=' ':
+            top=size*(.95-(.7 if c.isupper() or not c.isalpha() else .5))
+            bottom=size*.95
+            left,right=x+.1*w,x+.9*w
+            points=[]
+            for ax,ay in [(left,top),(right,top),(right,bottom),(left,bottom)]:
+                points+=[ax,ay,ax,ay,ax,ay]
+            points[16:18]=[right+.2*w,(3*top+bottom)/4.] # Bulge on the right side
+            strokes.append((points,True))
+        x+=w
+        previous=c
+    return strokes
+
+#----------------------------------------------------
+# Gimp objects
+#----------------------------------------------------
+class Parasite(object):
+    def __init__(self,name,flags,data):
+        self.name,self.flags,self.data=name,flags,data
+
+class Item(object):
+    def __init__(self,image,name):
+        self.image=image
+        self._name=name
+        self._visible=False
+        self.parasites={}
+
+    name=pdbProperty('_name','gimp_item_get_name')
+    visible=pdbProperty('_visible','gimp_item_get_visible')
+
+    def parasite_find(self,name):
+        call('gimp_item_get_parasite')
+        return self.parasites.get(name)
+
+    def attach_new_parasite(self,name,flags,data):
+        call('gimp_item_attach_parasite')
+        self.parasites[name]=Parasite(name,flags,data)
+
+class Layer(Item):
+    def __init__(self,image,text,size,font):
+        super(Layer,self).__init__(image,text)
+        self.text,self.size,self.font=text,size,font
+
+class VectorsBezierStroke(object):
+    def __init__(self,vectors,points,closed,count=True):
+        if count:
+            call('gimp_vectors_stroke_new_from_points')
+        self._points=[float(p) for p in points]
+        self._closed=bool(closed)
+        vectors._strokes.append(self)
+
+    @property
+    def points(self):
+        call('gimp_vectors_stroke_get_points')
+        return list(self._points),self._closed
+
+class Vectors(Item):
+    def __init__(self,image,name):
+        call('gimp_vectors_new')
+        super(Vectors,self).__init__(image,name)
+        self._strokes=[]
+
+    @property
+    def strokes(self):
+        call('gimp_vectors_get_strokes')
+        return list(self._strokes)
+
+class Image(object):
+    def __init__(self,width,height,type):
+        call('gimp_image_new')
+        self._width,self._height,self.type=width,height,type
+        self._filename=None
+        self._name='Untitled'
+        self.layers=[]
+        self.vectors=[]
+
+    width=pdbProperty('_width','gimp_image_width')
+    height=pdbProperty('_height','gimp_image_height')
+    filename=pdbProperty('_filename','gimp_image_get_filename')
+    name=pdbProperty('_name','gimp_image_get_name')
+
+    def disable_undo(self):
+        call('gimp_image_undo_disable')
+
+    def remove_layer(self,layer):
+        call('gimp_image_remove_layer')
+        self.layers.remove(layer)
+
+class Gimp(object):
+    Image=Image
+    Vectors=Vectors
+    VectorsBezierStroke=VectorsBezierStroke
+    Parasite=Parasite
+    directory='.'
+
+    def delete(self,item):
+        call('gimp_item_delete')
+
+    def message(self,message):
+        call('gimp_message')
+        messages.append(message)
+
+gimp=Gimp()
+
+#----------------------------------------------------
+# PDB procedures
+#----------------------------------------------------
+class PDB(object):
+    def gimp_text_get_extents_fontname(self,text,size,unit,font):
+        call('gimp_text_get_extents_fontname')
+        return textExtents(text,size)
+
+    def gimp_text_fontname(self,image,drawable,x,y,text,border,antialias,size,unit,font):
+        call('gimp_text_fontname')
+        layer=Layer(image,text,size,font)
+        image.layers.insert(0,layer)
+        return layer
+
+    def gimp_vectors_new_from_text_layer(self,image,layer):
+        call('gimp_vectors_new_from_text_layer')
+        vectors=Vectors.__new__(Vectors)
+        Item.__init__(vectors,image,layer.text)
+        vectors._strokes=[]
+        for points,closed in textStrokes(layer.text,layer.size):
+            VectorsBezierStroke(vectors,points,closed,count=False)
+        return vectors
+
+    def gimp_image_insert_vectors(self,image,vectors,parent,position):
+        call('gimp_image_insert_vectors')
+        image.vectors.insert(position,vectors)
+
+    def gimp_image_freeze_vectors(self,image):
+        call('gimp_image_freeze_vectors')
+
+    def gimp_image_thaw_vectors(self,image):
+        call('gimp_image_thaw_vectors')
+
+    def gimp_image_undo_group_start(self,image):
+        call('gimp_image_undo_group_start')
+
+    def gimp_image_undo_group_end(self,image):
+        call('gimp_image_undo_group_end')
+
+    def gimp_image_undo_freeze(self,image):
+        call('gimp_image_undo_freeze')
+
+    def gimp_image_undo_thaw(self,image):
+        call('gimp_image_undo_thaw')
+
+    def gimp_message(self,message):
+        call('gimp_message')
+        messages.append(message)
+
+    def gimp_context_get_font(self):
+        call('gimp_context_get_font')
+        return 'Sans'
+
+pdb=PDB()
+
+def register(*args,**kwargs):
+    pass
+
+def main():
+    pass
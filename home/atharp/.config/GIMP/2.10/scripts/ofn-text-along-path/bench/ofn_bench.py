@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Benchmarks for ofn-text-along-path, run outside of Gimp against the
+# in-memory gimpfu stub (gimpstub.py).
+#
+# Usage: python ofn_bench.py [options]   (Python 2, like the plugin)
+#
+#   --latency MS     latency of each PDB call, in milliseconds
+#   --repeat N       runs per case, the best time is kept
+#   --warm           keep the caches (glyphs, font metrics) between runs
+#   --only DIM       sweep only one dimension (text, strokes, anchors,
+#                    layout, generation)
+#   --json FILE      also write the results to FILE, to compare releases
+#
+# Each dimension is swept in turn, the other ones keeping their default
+# value. For each case the number of PDB calls per run, and the best wall
+# time are reported. Unless --warm is used, each run starts with empty
+# glyph and font metrics caches and a new image (so no stroke geometry
+# parasite either).
+
+import os, sys, imp, json, shutil, tempfile, timeit, argparse
+from collections import namedtuple, OrderedDict
+
+benchDir=os.path.dirname(os.path.abspath(__file__))
+pluginDir=os.path.dirname(benchDir)
+
+import gimpstub
+sys.modules['gimpfu']=gimpstub
+sys.path.insert(0,pluginDir)
+
+workDir=tempfile.mkdtemp(prefix='ofn-bench-')
+gimpstub.gimp.directory=workDir
+plugin=imp.load_source('ofn_text_along_path',os.path.join(pluginDir,'ofn-text-along-path.py'))
+
+Case=namedtuple('Case',['dimension','value','textLength','strokes','anchors','layout','generation'])
+
+defaults=OrderedDict([('text',32),('strokes',4),('anchors',16),('layout',plugin.Layout.CENTER),('generation',0)])
+sweeps=OrderedDict([
+    ('text',      [8,32,128,512]),
+    ('strokes',   [1,4,16,64]),
+    ('anchors',   [4,16,64,256]),
+    ('layout',    range(len(plugin.Layout.labels))),
+    ('generation',range(len(plugin.pathCollectorLabels))),
+    ])
+
+sampleText='The quick brown fox jumps over the lazy dog. AVATAR To Te LT Yo. '
+fontName='Sans'
+fontSize=20
+strokeWidth=6000.    # Long enough for the longest text
+strokeSpacing=60.
+
+def valueLabel(dimension,value):
+    if dimension=='layout':
+        return plugin.Layout.labels[value]
+    if dimension=='generation':
+        return plugin.pathCollectorLabels[value]
+    return str(value)
+
+def createCases(only):
+    cases=[]
+    for dimension,values in sweeps.items():
+        if only and dimension!=only:
+            continue
+        for value in values:
+            settings=defaults.copy()
+            settings[dimension]=value
+            cases.append(Case(dimension,valueLabel(dimension,value),settings['text'],settings['strokes'],
+                              settings['anchors'],settings['layout'],settings['generation']))
+    return cases
+
+# Stroke that waves around a horizontal line, with smooth anchors
+def waveStroke(y,anchors):
+    step=strokeWidth/(anchors-1)
+    points=[]
+    for i in range(anchors):
+        x=i*step
+        ay=y+(20 if i%2 else -20)
+        points+=[x-step/3.,ay,x,ay,x+step/3.,ay]
+    return points
+
+def createImage(case):
+    image=gimpstub.Image(int(strokeWidth)+100,int(case.strokes*strokeSpacing)+100,gimpstub.RGB)
+    image._filename=os.path.join(workDir,'bench.xcf')
+    guide=gimpstub.Vectors(image,'guide')
+    for i in range(case.strokes):
+        gimpstub.VectorsBezierStroke(guide,waveStroke(50+i*strokeSpacing,case.anchors),False)
+    return image,guide
+
+def resetCaches():
+    glyphFile=plugin.glyphCache.fileName
+    if os.path.exists(glyphFile):
+        os.remove(glyphFile)
+    plugin.glyphCache=plugin.GlyphCache(glyphFile,plugin.glyphCache.maxEntries)
+    plugin.fontMetrics=plugin.FontMetrics()
+
+def runCase(case,options):
+    text=(sampleText*(case.textLength//len(sampleText)+1))[:case.textLength].strip()
+    best=None
+    for _ in range(options.repeat):
+        if not options.warm:
+            resetCaches()
+        image,guide=createImage(case)
+        gimpstub.resetCalls()
+        start=timeit.default_timer()
+        plugin.textAlongPath(image,guide,text,'',fontName,fontSize,
+                             case.layout,True,0.,plugin.Pivot.BASELINE,0.,
+                             False,0,0,0,False,case.generation,False,0)
+        elapsed=timeit.default_timer()-start
+        errors=[m for m in gimpstub.messages if not m.startswith('Paths written')]
+        if errors:
+            raise Exception('%s=%s: %s' % (case.dimension,case.value,errors[0]))
+        if best is None or elapsed<best:
+            best=elapsed
+        calls=dict(gimpstub.calls)
+    return best,calls
+
+def main():
+    parser=argparse.ArgumentParser(description='ofn-text-along-path benchmarks')
+    parser.add_argument('--latency',type=float,default=0.,help='latency of each PDB call (ms)')
+    parser.add_argument('--repeat',type=int,default=3,help='runs per case')
+    parser.add_argument('--warm',action='store_true',help='keep caches between runs')
+    parser.add_argument('--only',choices=list(sweeps),help='sweep only this dimension')
+    parser.add_argument('--json',help='write the results to this file')
+    options=parser.parse_args()
+    gimpstub.latency=options.latency/1000.
+
+    results=[]
+    print '%-12s %-42s %8s %10s   %s' % ('Dimension','Value','Calls','Time (ms)','Most called')
+    try:
+        for case in createCases(options.only):
+            elapsed,calls=runCase(case,options)
+            mostCalled=sorted(calls.items(),key=lambda (name,count): -count)[:3]
+            print '%-12s %-42s %8d %10.2f   %s' % (case.dimension,case.value,sum(calls.values()),elapsed*1000,
+                                                  ', '.join(['%s:%d' % nc for nc in mostCalled]))
+            results.append(dict(case._asdict(),calls=calls,totalCalls=sum(calls.values()),time=elapsed))
+    finally:
+        shutil.rmtree(workDir,ignore_errors=True)
+    if options.json:
+        with open(options.json,'w') as f:
+            json.dump({'latency':options.latency,'repeat':options.repeat,'warm':options.warm,'results':results},
+                      f,indent=1,sort_keys=True)
+
+if __name__=='__main__':
+    main()
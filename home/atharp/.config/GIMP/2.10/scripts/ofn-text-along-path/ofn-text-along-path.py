@@ -32,6 +32,31 @@
 #   v1.4: 2017-11-18    * Add multiple words to strokes
 #   v1.5: 2019-07-30    * Fix bug/typo with boxes (thanks Teapot)
 #   v1.6: 2019-09-15    * Add top/middle of lowercase (thanks EsperMaschine)
+#   v1.7: 2026-10-18    * Keep rendered glyphs in a disk cache between runs
+#                       * Render each distinct character only once per text
+#                       * Memoize font metrics and kerning pairs
+#                       * Share font state and glyphs across lines in "multi"
+#                       * Sample strokes from their control points (arc-length table)
+#                       * Compute stroke direction from the curve derivative
+#                       * Sample all character positions of a stroke in one pass
+#                       * Adaptive stroke sampling driven by a pixel tolerance
+#                       * Keep stroke length tables in a parasite of the guide path
+#                       * Create character strokes directly at their final position
+#                       * Add all generated paths in one pass, optional undo limit
+#                       * Add generation options that write an SVG file
+#                       * Move geometry and layout to a Gimp-independent engine module
+#                       * Add benchmarks that run against a gimpfu stub (bench/)
+#                       * Add per-phase profiling (OFN_PROFILE)
+#                       * Lazy trace with categories, levels and an in-memory buffer
+#                       * Optional rendering of the whole text at once (word rendering)
+#                       * Small work image, shared, created only when rendering is needed
+#                       * Keep glyph outlines in flat arrays, placement works only from them
+#                       * Repeated characters are shared, placements kept in a compact table
+#                       * Place characters by chunks, memory use independent of stroke length
+#                       * Lay out paths with many strokes in parallel processes
+#                       * Add a wiggle seed, wiggles computed by stroke, skipped when not used
+#                       * Add a batch procedure, with jobs from a JSON manifest
+#                       * Read SVG guide paths directly, without Gimp
 #                      
 #
 #   This program is free software; you can redistribute it and/or modify
@@ -51,181 +76,442 @@
 # If you alter this program and redistribute it, please make it clear
 # that you are the author/maintainer of that version. Thank you.
 
-import math, random, os, sys, copy, itertools
+import os, sys, math, subprocess
 import traceback
+import marshal, hashlib, json, base64
 
-from collections import namedtuple
+from array import array
+
+from collections import OrderedDict
 from gimpfu import *
-  
-debug='OFN_DEBUG' in os.environ
-  
-def trace(s):
-    if debug:
-        print s
-
-# Init with [(symbol,label)...((symbol,label)]
-def createOpts(name,pairs):
-    optsclass=namedtuple(name+'Type',[symbol for symbol,label in pairs]+['labels','labelTuples'])
-    opts=optsclass(*(
-                    range(len(pairs))
-                    +[[label for symbol,label in pairs]]
-                    +[[(label,i) for i,(symbol,label) in enumerate(pairs)]]
-                    ))
-    return opts
-
-# Init with [(symbol,label,value,)...((symbol,label,value)]
-def createValuedOpts(name,triplets):
-    optsclass=namedtuple(name+'Type',[symbol for symbol,_,_ in triplets]+['labels','labelTuples','values'])
-    opts=optsclass(*(
-                    range(len(triplets))
-                    +[[label for _,label,_ in triplets]]
-                    +[[(label,i) for i,(_,label,_) in enumerate(triplets)]]
-                    +[[value for _,_,value in triplets]]
-                    ))
-    return opts
-
-# To set the text on the target path, each character is given a "pivot point".
-# This point is the point to be moved to the target path, as well as the center
-# of rotation to adjust the character tilt. The X coordinate of the pivot point
-# is always the middle of the character box (single-character text layer). 
-# The Y coordinate is  the combination of an adjustment value, and one of the 
-# following heights:
-
-Pivot=createOpts('Pivot',
-    [
-    ('BASELINE',  'Baseline'),                      # The baseline
-    ('TOP',       'Top of box'),                    # The top of the character box    
-    ('BOTTOM',    'Bottom of box'),                 # The bottom of the character box
-    ('BOXMIDDLE', 'Middle of box'),                 # The middle of the character box
-    ('UCTOP',     'Top of uppercase'),              # The top of uppercase characters
-    ('UCMIDDLE',  'Middle of uppercase'),           # The middle of uppercase characters
-    ('LCTOP',     'Top of lowercase'),              # The top of "regular" lowercase characters
-    ('LCMIDDLE',  'Middle of lowercase'),           # The middle of "regular" lowercase characters
-    ])
-
-# Characters that won't produce a path (space, etc...)
-blankCharacters=' '
-
-# Text formatting over the path. 
-# CENTER/LEFT/RIGHT will use the defined extra spacing
-# JUSTIFY/REPEAT compute an extra spacing to fit the stroke width
-Layout=createOpts('Layout',
-                    [('LEFT','Left'),('RIGHT','Right'),('CENTER','Center'),
-                    ('JUSTIFY','Justify'),('REPEAT','Repeat')])
+
+# Geometry, layout and path collection are in a Gimp-independent module
+from ofn_text_along_path_engine import (debug, toBytes, tracer, TraceLevel, profiler, Pivot, Layout, dumpStrokes,
+                                        DirectionStroke, GlyphProvider, PathCollector, Formatter, ParallelLayout,
+                                        SVGOnePathToRuleThemAll, SVGOnePathPerStroke, SVGTextAndSpacer, SVGEachOnItsOwn)
+from ofn_text_along_path_svg import readSVGPaths
 
 def dumpPath(path):
-    for stroke in path.strokes:
-        print '---'
-        points,closed=stroke.points
-        for i in range(0,len(points),6):
-            print '***%7.2f,%7.2f <--- %7.2f,%7.2f ---> %7.2f,%7.2f' % tuple((points[i:i+6]))
+    dumpStrokes([stroke.points for stroke in path.strokes])
 
 #----------------------------------------------------
-# Enhanced path Stroke
+# Profiling
+#
+# With OFN_PROFILE set, the calls through "pdb" and "gimp" are counted in 
+# the current phase (calls to the methods of Gimp objects, such as 
+# stroke.points, are not), and a JSON summary of each run is shown with
+# gimp_message(), or appended to the file named by OFN_PROFILE (unless 
+# its value is "1").
 #----------------------------------------------------
-class DirectionStroke:
-            
-    def __init__(self,stroke,backwards):
-        self.stroke=stroke
-        self.backwards=backwards
-        self.delta=-0.5 if self.backwards else 0.5
-        self.points,self.closed=self.stroke.points
-        bezierCurves=(len(self.points)/3)-1
+class CountingProxy(object):
+    def __init__(self,target):
+        self.target=target
         
-        # Number of curves seems to have an influence on global
-        # precision, so adapt precision to number of curves forsft  
-        # best results
-        self.precision=.05/bezierCurves
-
-        # The stroke length, computed once for all. 
-        # It appears that due to precision errors
-        # self.stroke.get_point_at_dist(self.length) 
-        # may not return a valid point.
-        self.length=stroke.get_length(self.precision)
-
-    # Obtain the oriented angle of the tangent at point. The Gimp API gives
-    # an actual slope value without orientation, so we disambiguate using
-    # an auxiliary point a bit farther in the stroke. This could lead to problems
-    # if used too close to the end point (auxiliary point outside the stroke)
-    # but we will only use this at least half a character away from the end.
-    def computeOrientedSlope(self,dx,dy,slope):
-        if abs(slope) >100000: # very vertical
-            return math.atan2(dy,dx) # no perfect, but properly oriented
-        # keep dx/dy signs but give then the same ratio as in slope
-        return math.atan2(math.copysign(slope,dy),math.copysign(1,dx))
+    def __getattr__(self,name):
+        attr=getattr(self.target,name)
+        if not callable(attr):
+            return attr
+        def counted(*args,**kwargs):
+            profiler.countCall()
+            return attr(*args,**kwargs)
+        return counted
+
+if profiler.enabled:
+    pdb=CountingProxy(pdb)
+    gimp=CountingProxy(gimp)
+
+def reportProfile(procedure,guidePath,text,layout,generationType):
+    if not profiler.enabled:
+        return
+    summary=profiler.summary(procedure=procedure,text=text,strokes=len(guidePath.strokes),
+                             layout=Layout.labels[layout],generation=pathCollectorLabels[generationType])
+    profileFile=os.getenv('OFN_PROFILE')
+    if profileFile in ('','1'):
+        pdb.gimp_message(json.dumps(summary,indent=1))
+        return
+    try:
+        with open(profileFile,'a') as f:
+            f.write(json.dumps(summary)+'\n')
+    except Exception as e: # Profiling is not a reason to fail
+        tracer.log('general',TraceLevel.WARNING,'Profile not written: %s',e)
+
+#----------------------------------------------------
+# Persistent glyph cache
+#
+# Rendering a glyph takes several PDB round-trips (text layer creation,
+# conversion to path, layer removal). The glyph sizes and outlines are
+# kept in a file in the Gimp profile directory, keyed by (font, font 
+# stamp, size, character), so that later runs can skip the rendering.
+# The font stamp (see FontStamps) changes when the font is updated. The least 
+# recently used glyphs are evicted when the cache exceeds its size limit. 
+# The size limit can be set with the OFN_TEXT_ALONG_PATH_GLYPH_CACHE 
+# environment variable (0 disables the cache).
+#
+# The file is only rewritten when glyphs are added, or when glyphs close
+# to eviction (in the older half of the cache) are used again, so a run
+# that finds all its glyphs in the cache doesn't write it. It holds only
+# plain data (strings, numbers and tuples, written with marshal).
+#----------------------------------------------------
+class GlyphCache(object):
+    version=3
     
-    # Facade method, returns only if point is OK
-    def getRawPointAtDist(self,dist):
-        x,y,slope,valid=self.stroke.get_point_at_dist(dist,self.precision)
-        if not valid: # Normally quite unlikely, since we avoid the cases where this could happen
-            raise Exception('No point found at %6.4f in stroke %s with length %6.4f' % (dist,self.stroke.ID,self.length))
-        return x,y,slope
+    def __init__(self,fileName,maxEntries):
+        self.fileName=fileName
+        self.maxEntries=maxEntries
+        self.glyphs=None # Loaded on first use
+        self.ranks={} # key -> position in the file (0 for the least recently used)
+        self.dirty=False
+        self.hits=0
+        self.misses=0
+        
+    def load(self):
+        self.glyphs=OrderedDict()
+        if not self.maxEntries:
+            return
+        try:
+            with open(self.fileName,'rb') as f:
+                version,entries=marshal.load(f)
+            if version==self.version:
+                for fontName,fontStamp,fontSize,character,width,height,strokes in entries:
+                    self.glyphs[(fontName,fontStamp,fontSize,character)]=(width,height,strokes)
+                self.ranks=dict((key,i) for i,key in enumerate(self.glyphs))
+        except Exception as e: # Missing or unreadable file, start afresh
+            tracer.log('font',TraceLevel.WARNING,'Glyph cache not loaded: %s',e)
+            
+    # Returns (width,height,strokes) or None, strokes being a list 
+    # of (points,closed) tuples (empty for blank characters)
+    def get(self,fontName,fontStamp,fontSize,character):
+        if self.glyphs is None:
+            self.load()
+        key=(fontName,fontStamp,fontSize,character)
+        glyph=self.glyphs.pop(key,None)
+        if glyph is None:
+            self.misses+=1
+            return None
+        self.hits+=1
+        self.glyphs[key]=glyph # Reinserted as the most recently used
+        # Glyphs that would be evicted after less than half the cache size of new glyphs
+        if self.ranks.get(key,self.maxEntries)+self.maxEntries-len(self.ranks)<self.maxEntries//2:
+            self.dirty=True
+        return glyph
+
+    def put(self,fontName,fontStamp,fontSize,character,width,height,strokes):
+        if not self.maxEntries:
+            return
+        if self.glyphs is None:
+            self.load()
+        self.glyphs[(fontName,fontStamp,fontSize,character)]=(width,height,[(tuple(points),closed) for points,closed in strokes])
+        while len(self.glyphs)>self.maxEntries:
+            self.glyphs.popitem(last=False)
+        self.dirty=True
+
+    def save(self):
+        tracer.log('font',TraceLevel.INFO,'Glyph cache: %d hits, %d misses',self.hits,self.misses)
+        if not (self.dirty and self.maxEntries):
+            return
+        # Write to a temporary file and rename, so that concurrent runs never see a partial file
+        tmpName=self.fileName+'.tmp'
+        try:
+            entries=[key+glyph for key,glyph in self.glyphs.items()]
+            with open(tmpName,'wb') as f:
+                marshal.dump((self.version,entries),f,2)
+            if os.name=='nt' and os.path.exists(self.fileName):
+                os.remove(self.fileName) # No atomic replace on Windows
+            os.rename(tmpName,self.fileName)
+            self.ranks=dict((key,i) for i,key in enumerate(self.glyphs))
+            self.dirty=False
+        except Exception as e: # A cache that cannot be saved is not a reason to fail 
+            tracer.log('font',TraceLevel.WARNING,'Glyph cache not saved: %s',e)
+
+glyphCache=GlyphCache(os.path.join(gimp.directory,'ofn-text-along-path.glyphs'),
+                      int(os.getenv('OFN_TEXT_ALONG_PATH_GLYPH_CACHE',5000)))
+
+#----------------------------------------------------
+# Font metrics
+#
+# gimp_text_get_extents_fontname() is called for every glyph and every
+# kerning pair. The results are memoized for the whole process, keyed
+# by (font, size, string), so that repeated pairs and later Formatters
+# don't go through the PDB again.
+#----------------------------------------------------
+class FontMetrics(object):
+    kinds=['glyph','pair','text']
+
+    def __init__(self):
+        self.cache={}
+        self.hits=[0]*len(self.kinds)
+        self.misses=[0]*len(self.kinds)
+
+    def extents(self,fontName,fontSize,text):
+        kind=min(len(text),3)-1 
+        key=(fontName,fontSize,text)
+        ext=self.cache.get(key)
+        if ext is None:
+            self.misses[kind]+=1
+            ext=self.cache[key]=tuple(pdb.gimp_text_get_extents_fontname(text, fontSize, PIXELS, fontName))
+        else:
+            self.hits[kind]+=1
+        return ext
+
+    def report(self):
+        for kind,hits,misses in zip(self.kinds,self.hits,self.misses):
+            if hits+misses:
+                tracer.log('font',TraceLevel.INFO,'Font metrics (%s): %d hits, %d misses, %3.1f%% hit rate',kind,hits,misses,100.*hits/(hits+misses))
+        
+fontMetrics=FontMetrics()
+
+#----------------------------------------------------
+# Font stamps
+#
+# Glyphs are cached by font name, so a font updated or replaced under the
+# same name would keep returning its old glyphs. The stamp of a font is
+# part of the glyph cache keys: the size and modification time of the
+# font file, as found by fontconfig's fc-match (when available, and not on
+# Windows where it would open a console), and the metrics of a sample text
+# (for fonts whose file can't be found). It is computed once per font.
+#----------------------------------------------------
+fontStyles={'thin':'thin','ultralight':'extralight','extralight':'extralight','light':'light','semilight':'demilight',
+            'book':'book','regular':None,'normal':None,'roman':None,'medium':'medium','semibold':'demibold',
+            'demibold':'demibold','bold':'bold','ultrabold':'extrabold','extrabold':'extrabold','heavy':'black',
+            'black':'black','italic':'italic','oblique':'oblique','condensed':'condensed',
+            'semicondensed':'semicondensed','expanded':'expanded'}
+
+class FontStamps(object):
+    sample='Hamburgefonstiv 0123456789'
+    sampleSize=100
+
+    def __init__(self):
+        self.stamps={}
+
+    def get(self,fontName):
+        stamp=self.stamps.get(fontName)
+        if stamp is None:
+            stamp=self.stamps[fontName]=(self.fileStamp(fontName),)+tuple(fontMetrics.extents(fontName,self.sampleSize,self.sample))
+            tracer.log('font',TraceLevel.INFO,'Font stamp for "%s": %s',fontName,stamp)
+        return stamp
+
+    # Fontconfig pattern for a Gimp (Pango) font name: the style words
+    # at the end of the name become fontconfig constants
+    def pattern(self,fontName):
+        words=fontName.split()
+        styles=[]
+        while len(words)>1 and words[-1].lower().replace('-','') in fontStyles:
+            styles.insert(0,fontStyles[words.pop().lower().replace('-','')])
+        family=' '.join(words)
+        for c in '\\-:,':
+            family=family.replace(c,'\\'+c)
+        return ':'.join([family]+[style for style in styles if style])
+
+    def fileStamp(self,fontName):
+        if os.name=='nt':
+            return None
+        try:
+            fileName=subprocess.check_output(['fc-match','-f','%{file}',self.pattern(fontName)])
+            info=os.stat(fileName)
+            return (info.st_size,int(info.st_mtime))
+        except Exception as e: # No fontconfig tools, the metrics only
+            tracer.log('font',TraceLevel.INFO,'No font file for "%s": %s',fontName,e)
+            return None
+
+fontStamps=FontStamps()
+
+#----------------------------------------------------
+# Stroke geometry cache
+#
+# The arc-length tables of the strokes are kept in a persistent parasite 
+# of the guide path (so they are also saved in the XCF), keyed by a hash 
+# of the stroke control points and of the tolerance. Running the script
+# again on an unchanged path skips the table computations. Only the 
+# tables of the current strokes are kept. 
+#
+# The parasite comes with the XCF, so it is plain data: JSON of the keys 
+# and of the tables (little-endian doubles, in base64), that is checked
+# when loaded.
+#----------------------------------------------------
+class StrokeGeometryCache(object):
+    parasiteName='ofn-text-along-path-geometry'
+    version=3
     
-    # Enhanced version of stroke.get_point_at_dist(...) that returns
-    # information about the path direction. A full version should be able to 
-    # handle special cases (extremities or past extremities) but this one is 
-    # user at half a caharcter width from the stroke extremities.
-    # 
-    def getPointAtDist(self,dist):
-        if self.backwards:
-            dist=self.length-dist
-        x,y,slope=self.getRawPointAtDist(dist)
+    def __init__(self,path):
+        self.path=path
+        self.tables={} # key -> (dists,params) packed as strings
+        self.used=set()
+        self.dirty=False
+        try:
+            parasite=path.parasite_find(self.parasiteName)
+            if parasite:
+                self.tables=self.unpack(parasite.data)
+        except Exception as e: # Unreadable parasite, start afresh
+            tracer.log('geometry',TraceLevel.WARNING,'Stroke geometry not loaded: %s',e)
+
+    @staticmethod
+    def toLittleEndian(packed):
+        if sys.byteorder=='little':
+            return packed
+        values=array('d')
+        values.fromstring(packed)
+        values.byteswap()
+        return values.tostring()
+
+    def unpack(self,data):
+        content=json.loads(data)
+        if content.get('version')!=self.version:
+            return {}
+        tables={}
+        for key,(dists,params) in content['tables'].items():
+            dists,params=[self.toLittleEndian(base64.b64decode(t)) for t in (dists,params)]
+            if len(dists)!=len(params) or not dists or len(dists)%array('d').itemsize:
+                raise ValueError('Bad table for stroke %s' % key)
+            tables[str(key)]=(dists,params)
+        return tables
+
+    def pack(self,tables):
+        return json.dumps({'version':self.version,
+                           'tables':dict((key,[base64.b64encode(self.toLittleEndian(t)) for t in packed]) 
+                                         for key,packed in tables.items())})
         
-        # Find the direction of the curve at given point, by comparing 
-        # coordinates with nearby point further along the path at an 
-        # arbitrary distance delta. We assume that dist+delta is still 
-        # on the curve (ie, dist no too close to end)
-        toX,toY,s=self.getRawPointAtDist(dist+self.delta) 
-        theta=self.computeOrientedSlope(toX-x,toY-y,slope)
-        #trace("D: %3.2f -> %3.2f, %3.2f @%3.2f°" % (dist,x,y,theta*180/math.pi)) 
-        return (x,y,theta)
+    def key(self,points,closed,tolerance):
+        return hashlib.md5(repr((list(points),closed,tolerance))).hexdigest()
+        
+    def get(self,points,closed,tolerance):
+        key=self.key(points,closed,tolerance)
+        packed=self.tables.get(key)
+        if not packed:
+            return None
+        self.used.add(key)
+        dists,params=array('d'),array('d')
+        dists.fromstring(packed[0])
+        params.fromstring(packed[1])
+        return dists,params
+
+    def put(self,points,closed,tolerance,dists,params):
+        key=self.key(points,closed,tolerance)
+        self.tables[key]=(array('d',dists).tostring(),array('d',params).tostring())
+        self.used.add(key)
+        self.dirty=True
+        
+    def save(self):
+        if not (self.dirty or self.used!=set(self.tables)):
+            return
+        tables=dict((key,self.tables[key]) for key in self.used)
+        self.path.attach_new_parasite(self.parasiteName,PARASITE_PERSISTENT,self.pack(tables))
+        tracer.log('geometry',TraceLevel.INFO,'Stroke geometry saved for %d strokes',len(tables))
+
+#----------------------------------------------------
+# Glyph provider for the engine, that renders the text in a 
+# work image and obtains the glyphs through the glyph cache
+#
+# If the OFN_TEXT_ALONG_PATH_WORD_RENDER environment variable is set
+# to 1, the text is rendered as a whole and split in characters (see
+# the Formatter), instead of rendering each character on its own.
+#----------------------------------------------------
+wordRender=bool(int(os.getenv('OFN_TEXT_ALONG_PATH_WORD_RENDER',0)))
+
+# The work image is only used to convert text layers to paths. The text 
+# layers are sized by the text, not by the image, so a 1x1 grayscale image
+# is enough whatever the font size. It is created on first use (so not at 
+# all if all glyphs come from the cache), shared by all glyph providers, 
+# and released at the end of the run.
+class WorkImage(object):
+    def __init__(self):
+        self.image=None
+
+    def get(self):
+        if self.image is None:
+            with profiler.phase('workImage'):
+                self.image=gimp.Image(1,1,GRAY)
+                self.image.disable_undo()
+        return self.image
+
+    def release(self):
+        if self.image is not None:
+            gimp.delete(self.image)
+            self.image=None
+
+workImage=WorkImage()
+
+class GimpGlyphProvider(GlyphProvider):
+    def extents(self,text):
+        return fontMetrics.extents(self.fontName,self.fontSize,text)
+        
+    def outline(self,text):
+        image=workImage.get()
+        l=pdb.gimp_text_fontname(image, None, 0, 0, text, 0, True, self.fontSize, PIXELS, self.fontName)
+        path=pdb.gimp_vectors_new_from_text_layer(image,l)
+        image.remove_layer(l)
+        strokes=[stroke.points for stroke in path.strokes]
+        gimp.delete(path)
+        return strokes
+        
+    def glyph(self,c):
+        cached=glyphCache.get(self.fontName,fontStamps.get(self.fontName),self.fontSize,c)
+        if cached:
+            return cached
+        width,height,strokes=super(GimpGlyphProvider,self).glyph(c)
+        glyphCache.put(self.fontName,fontStamps.get(self.fontName),self.fontSize,c,width,height,strokes)
+        return width,height,strokes
+
+    # Whole texts are kept in the glyph cache like single characters
+    def textOutline(self,text):
+        cached=glyphCache.get(self.fontName,fontStamps.get(self.fontName),self.fontSize,text)
+        if cached:
+            return cached[2]
+        width,height,_,_=self.extents(text)
+        strokes=self.outline(text)
+        glyphCache.put(self.fontName,fontStamps.get(self.fontName),self.fontSize,text,width,height,strokes)
+        return strokes
 
 #---------------------------------------------------------------------------
 # PathCollectors
 #
-# These objects accumulate the paths produced when laying out the characters.
-# 
-# They are implemented as Python context managers, context exit triggering
-# the actual addition of the paths to the image (otherwise they are discarded)
+# These collectors (see the engine) add the paths to the image, context 
+# exit triggering the actual addition (otherwise they are discarded).
+#
+# The paths are added in one pass, in a single undo group, with the Paths
+# list frozen (Gimp 2.10.14 and later) so that it is updated only once. They
+# are made visible before being added, so this doesn't add an undo step for 
+# each.
 #---------------------------------------------------------------------------
+canFreezeVectors=hasattr(pdb,'gimp_image_freeze_vectors') # Gimp 2.10.14
 
-class PathCollector(object):
+class VectorsCollector(PathCollector):
     def __init__(self,image,pathName,showBoxes):
+        super(VectorsCollector,self).__init__(pathName,showBoxes)
         self.image=image
-        self.pathName=pathName
-        self.showBoxes=showBoxes
         self.paths=[]
 
-    def __exit__(self,exc_type, exc_val, exc_tb):
-        if not exc_type:  # Normal end
-            trace("Path collection ended, adding %d paths" % len(self.paths))
+    def addPaths(self):
+        pdb.gimp_image_undo_group_start(self.image)
+        if canFreezeVectors:
+            pdb.gimp_image_freeze_vectors(self.image)
+        try:
             for p in self.paths:
-                pdb.gimp_image_add_vectors(self.image,p,0)
                 p.visible=True
+                pdb.gimp_image_insert_vectors(self.image,p,None,0)
+        finally:
+            if canFreezeVectors:
+                pdb.gimp_image_thaw_vectors(self.image)
+            pdb.gimp_image_undo_group_end(self.image)
+        
+    def __exit__(self,exc_type, exc_val, exc_tb):
+        if not exc_type:  # Normal end
+            tracer.log('collector',TraceLevel.INFO,"Path collection ended, adding %d paths",len(self.paths))
+            with profiler.phase('insertion'):
+                self.addPaths()
         else:
             for p in self.paths:
                 gimp.delete(p)
         return False        
 
-    # Overloaded by the classes that use them
-    def enterStroke(self,strokeIndex):
-        pass;
-
-    def enterCharacter(self,charIndex,char):
-        pass;
+    # Gimp's own Stroke.translate() isn't usable here since it truncates the 
+    # offsets to integer values, and Stroke.rotate() is one more PDB call per
+    # stroke, so the new stroke is created at its final position.
+    def copyMoveStrokes(self,strokes,targetPath,cX,cY,pX,pY,tilt):
+        placement=self.placement(cX,cY,pX,pY,tilt)
+        for points,closed in self.moveOutline(strokes,placement):
+            gimp.VectorsBezierStroke(targetPath,points,closed)
 
-    def copyMovePath(self,sourcePath,targetPath,cX,cY,pX,pY,tilt):
-        offsets=itertools.cycle([cX,cY])
-        for sourceStroke in sourcePath.strokes:
-            # Workaround because Gimp's own Stroke.translate() isn't usable here since it
-            # truncates the offsets to integer values. So, after rotating the stroke, we
-            # get the points, translate the points, and add them back as a new stroke.
-            points,closed=sourceStroke.points
-            translated=[coord+next(offsets) for coord in points]
-            copiedStroke = gimp.VectorsBezierStroke(targetPath,translated,closed)
-            copiedStroke.rotate(cX+pX,cY+pY,tilt)
-
-class OnePathToRuleThemAll(PathCollector):
+class OnePathToRuleThemAll(VectorsCollector):
     def __init__(self,image,pathName,showBoxes):
         super(OnePathToRuleThemAll,self).__init__(image,pathName,showBoxes)
         self.path=None
@@ -238,14 +524,14 @@ def __enter__(self):
             self.boxesPath=gimp.Vectors(self.image,'Boxes for '+self.pathName) 
             self.paths.append(self.boxesPath)        
 
-    def addCharacter(self,cPath,cX,cY,pX,pY,tilt,cType):
-        self.copyMovePath(cPath,self.path,cX,cY,pX,pY,tilt)
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.copyMoveStrokes(cStrokes,self.path,cX,cY,pX,pY,tilt)
 
-    def addBox(self,bPath,cX,cY,pX,pY,tilt,cType):
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
         if self.showBoxes:
-            self.copyMovePath(bPath,self.boxesPath,cX,cY,pX,pY,tilt)
+            self.copyMoveStrokes(bStrokes,self.boxesPath,cX,cY,pX,pY,tilt)
 
-class OnePathPerStroke(PathCollector):
+class OnePathPerStroke(VectorsCollector):
     def __init__(self,image,pathName,showBoxes):
         super(OnePathPerStroke,self).__init__(image,pathName,showBoxes)
         self.path=None
@@ -261,14 +547,14 @@ def enterStroke(self,strokeIndex):
             self.boxesPath=gimp.Vectors(self.image,'Boxes for %s[%02d]' % (self.pathName,strokeIndex)) 
             self.paths.append(self.boxesPath)        
 
-    def addCharacter(self,cPath,cX,cY,pX,pY,tilt,cType):
-        self.copyMovePath(cPath,self.path,cX,cY,pX,pY,tilt)
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.copyMoveStrokes(cStrokes,self.path,cX,cY,pX,pY,tilt)
 
-    def addBox(self,bPath,cX,cY,pX,pY,tilt,cType):
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
         if self.showBoxes:
-            self.copyMovePath(bPath,self.boxesPath,cX,cY,pX,pY,tilt)
+            self.copyMoveStrokes(bStrokes,self.boxesPath,cX,cY,pX,pY,tilt)
 
-class TextAndSpacer(PathCollector):
+class TextAndSpacer(VectorsCollector):
     def __init__(self,image,pathName,showBoxes):
         super(TextAndSpacer,self).__init__(image,pathName,showBoxes)
         self.path=None
@@ -285,14 +571,14 @@ def __enter__(self):
             self.bPaths=[textPath,joinPath]
             self.paths.extend(self.bPaths)
 
-    def addCharacter(self,cPath,cX,cY,pX,pY,tilt,cType):
-        self.copyMovePath(cPath,self.cPaths[cType],cX,cY,pX,pY,tilt)
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.copyMoveStrokes(cStrokes,self.cPaths[cType],cX,cY,pX,pY,tilt)
 
-    def addBox(self,bPath,cX,cY,pX,pY,tilt,cType):
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
         if self.showBoxes:
-            self.copyMovePath(bPath,self.bPaths[cType],cX,cY,pX,pY,tilt)
+            self.copyMoveStrokes(bStrokes,self.bPaths[cType],cX,cY,pX,pY,tilt)
 
-class EachOnItsOwn(PathCollector):
+class EachOnItsOwn(VectorsCollector):
     def __init__(self,image,pathName,showBoxes):
         super(EachOnItsOwn,self).__init__(image,pathName,showBoxes)
         
@@ -306,427 +592,317 @@ def enterCharacter(self,charIndex,char):
         self.charPath=gimp.Vectors(self.image,'%s[%02d][%s]' % (self.strokeName,charIndex,char))
         self.paths.append(self.charPath)
 
-    def addCharacter(self,cPath,cX,cY,pX,pY,tilt,cType):
-        self.copyMovePath(cPath,self.charPath,cX,cY,pX,pY,tilt)
+    def addCharacter(self,cStrokes,cX,cY,pX,pY,tilt,cType):
+        self.copyMoveStrokes(cStrokes,self.charPath,cX,cY,pX,pY,tilt)
 
-    def addBox(self,bPath,cX,cY,pX,pY,tilt,cType):
+    def addBox(self,bStrokes,cX,cY,pX,pY,tilt,cType):
         if self.showBoxes:
-            self.copyMovePath(bPath,self.charPath,cX,cY,pX,pY,tilt)
+            self.copyMoveStrokes(bStrokes,self.charPath,cX,cY,pX,pY,tilt)
 
-pathCollectorTypes= [OnePathToRuleThemAll,OnePathPerStroke,      TextAndSpacer,                   EachOnItsOwn]
-pathCollectorLabels=["One single path",   "One path per stroke", "Separate text and spacer paths","One path per character"]
+#---------------------------------------------------------------------------
+# SVG collectors (see the engine) write the paths to a file next to the 
+# image file (or in the home directory if the image hasn't been saved),
+# with a numeric suffix if the file already exists, or to the output file
+# of the batch job.
+#---------------------------------------------------------------------------
+svgOutputFile=None # Set by the batch jobs
 
-#----------------------------------------------------
-# Character in text
-#----------------------------------------------------
-CTYPE_TEXT=0
-CTYPE_JOIN=1
-
-class Character(object):
-    def __init__(self,character,width,height,ctype):
-        self.character=character
-        self.width=width
-        self.height=height
-        self.path=None
-        self.boxPath=None
-        self.marginL=0
-        self.marginR=0
-        self.kerning=0 # Normally negative when characters are squeezed (AV, XO)
-        self.position=0
-        self.ctype=ctype
-        
-    def __str__(self):
-        if self.path:
-            return "<'%s' (%d,%d) @%3.2f, [%s], %d stroke(s)>" % (self.character,self.width,self.height,self.position,"TS"[self.ctype],len(self.path.strokes))
-        else:
-            return "<'%s' (%d,%d) @%3.2f, [%s], (no path)>" % (self.character,self.width,self.height,self.position,"TS"[self.ctype])
-    
-    def __repr__(self):
-        return str(self)
-    
-    def dumpPath(self):
-        if self.path:
-           dumpPath(self.path)
+def svgFileName(image):
+    if svgOutputFile:
+        if os.path.exists(svgOutputFile):
+            tracer.log('collector',TraceLevel.INFO,'Overwriting %s',svgOutputFile)
+        return svgOutputFile
+    if image.filename:
+        base=os.path.splitext(image.filename)[0]
+    else:
+        base=os.path.join(os.path.expanduser('~'),os.path.splitext(image.name)[0])
+    fileName=base+'-text-along-path.svg'
+    number=1
+    while os.path.exists(fileName):
+        number+=1
+        fileName='%s-text-along-path-%d.svg' % (base,number)
+    return fileName
 
-#----------------------------------------------------
-# Text to work on
-#----------------------------------------------------
-class Formatter(object):
-    
-    def __init__(self,text,joiner,fontName,fontSize,
-            layout=Layout.CENTER, useKerning=True, extraSpacing=0,
-            pivotYChoice=Pivot.BASELINE, verticalAdjust=0,
-            keepUpright=False,wiggleXPercent=0, wiggleYPercent=0, wiggleTheta=0):
-        self.text=list(unicode(text,'utf-8','strict'))
-        self.joiner=list(unicode(joiner,'utf-8','strict'))
-        self.fontName=fontName
-        self.fontSize=fontSize
-        self.layout=layout
-        self.useKerning=useKerning
-        self.extraSpacing=extraSpacing
-        self.pivotYChoice=pivotYChoice
-        self.verticalAdjust=verticalAdjust
-        self.keepUpright=keepUpright
-        self.wiggleXPercent=wiggleXPercent
-        self.wiggleYPercent=wiggleYPercent
-        self.wiggleTheta=wiggleTheta
-        
-        self.pivotY=None
-        self.textCharacters=[]
-        self.joinCharacters=[]
-        self.workImage=gimp.Image(int(fontSize*4),int(fontSize*4), RGB)
-        self.workImage.disable_undo()
-        self.computePivotY()
-        self.initializeCharacters()
-        
-    def __del__(self):
-        gimp.delete(self.workImage)
+def svgCollector(collectorType):
+    def create(image,pathName,showBoxes):
+        return collectorType(image.width,image.height,pathName,showBoxes,svgFileName(image),pdb.gimp_message)
+    create.svg=True
+    return create
 
-    def extents(self,text):
-        ext = pdb.gimp_text_get_extents_fontname(text, self.fontSize, PIXELS, self.fontName)
-        #trace("extents[w](%s)=%3.2f" % (text,ext[0]))
-        return ext
-        
-    def boxPath(self,w,h):
-        w,h=float(w),float(h)
-        path=gimp.Vectors(self.workImage,'**')
-        points=[0.,0.]*3+[w,0.]*3+[w,h]*3+[0.,h]*3
-        gimp.VectorsBezierStroke(path,points,True)
-        return path
-        
-    def textPath(self,text):
-        l=pdb.gimp_text_fontname(self.workImage, None, 0, 0, text, 0, True, self.fontSize, PIXELS, self.fontName)
-        path=pdb.gimp_vectors_new_from_text_layer(self.workImage,l)
-        self.workImage.remove_layer(l)
-        return path
-        
-    def createCharacter(self,c,k,ctype):
-        cw,ch,_,_=self.extents(c)
-        char=Character(c,cw,ch,ctype)
-        if c not in blankCharacters:
-            char.path=self.textPath(c)
-            char.boxPath=self.boxPath(cw,ch)
-            # compute margins
-            allX=[x for stroke in char.path.strokes for x in stroke.points[0][0::2]]
-            char.marginL=min(allX)
-            char.marginR=cw-max(allX)
-        
-        # compute kerning if necessary
-        if k and self.useKerning:
-            kw,_,_,_=self.extents(k)
-            pw,_,_,_=self.extents(k+c)
-            # Kerning is the difference between width of the pair with kerning (pw) 
-            # and the sum of the individual character widths (can be negative: "AV")
-            char.kerning=pw-(cw+kw)
-            trace('Kerning %c -> %c: %3.2f - (%3.2f + %3.2f) = %3.2f' % (k,c,pw,cw,kw,char.kerning))
-        return char
-    
-    def initializeCharacters(self):
-        trace('Text: %s, Joiner: %s' % (''.join(self.text),''.join(self.joiner)))
-        # To compute kerning a character needs to know the character on its right
-        # For the first character of the text this is the last character of the text or the joiner
-        # Kerning for 1st character is always computed even if its not used on open strokes
-        firstKerning=self.joiner[-1] if self.joiner and self.layout==Layout.REPEAT else self.text[-1]            
-        kerningCharacters=[firstKerning]+self.text[:-1]
-        self.textCharacters=[self.createCharacter(c,k,CTYPE_TEXT) for c,k in zip(self.text,kerningCharacters)]
-        
-        if self.joiner:
-        # For the first character of the joiner this is the last character of the text
-            firstKerning=self.text[-1]   
-            kerningCharacters=[firstKerning]+self.joiner[:-1]
-            self.joinCharacters=[self.createCharacter(c,k,CTYPE_JOIN) for c,k in zip(self.joiner,kerningCharacters)]
-                        
-    # Compute offsets for pivot point Y. Since there is no API to obtain geometry information
-    # for the font, some guesswork is required. We will assume that 'X' and 'x' are fairly symmetrical
-    # and that their topmost point is as much above the line of upper/lowercase tops than their lowest point
-    # is below the baseline (except for very round fonts this will be 0).
-    
-    def verticalSpread(self,text,ascent):
-        # Obtain path for sample text
-        path=self.textPath(text)
-        # Gather all Y values (anchors and handles) in all strokes for the bounding box 
-        allY=[y for stroke in path.strokes for y in stroke.points[0][1::2]] 
-        gimp.delete(path)
-        minY=min(allY)
-        maxY=max(allY)
-        top=minY+(maxY-ascent)
-        middle=(minY+maxY)/2.
-        return top,middle
-    
-    def computePivotY(self):
-        
-        width,height,ascent,descent=self.extents('X')
-        trace(
-'''
-==================
-Width:     %7.2f
-Height:    %7.2f
-Ascent:    %7.2f
-Descent:   %7.2f
-------------------
-''' % (width,height,ascent,descent))
-        self.wiggleYMax=height
-    
-        # compute all possible pivotY and keep the good one (easier to debug)
-        pivot=[0 for _ in Pivot.labels] # Array of same size as choices
-        pivot[Pivot.BASELINE]=ascent
-        pivot[Pivot.TOP]=0
-        pivot[Pivot.BOTTOM]=height
-        pivot[Pivot.BOXMIDDLE]=height/2.
-        pivot[Pivot.UCTOP],pivot[Pivot.UCMIDDLE]=self.verticalSpread('X',ascent)
-        pivot[Pivot.LCTOP],pivot[Pivot.LCMIDDLE]=self.verticalSpread('x',ascent)
-        
-        trace(
-'''
-Baseline:  %7.2f
-Top:       %7.2f
-Bottom:    %7.2f
-MiddleBox: %7.2f
-TopUC:     %7.2f
-MiddleUC:  %7.2f
-TopLC:     %7.2f
-MiddleLC:  %7.2f
-''' % tuple(pivot))
-        self.pivotY=pivot[self.pivotYChoice]+self.verticalAdjust
-
-    # Functions to compute how to layout the characters on the stroke 
-    # Return:
-    #  - actual character sequence
-    #  - actual extra spacing
-    #  - total string width
-    
-    def checkFit(self,textWidth,strokeLength):
-         if textWidth > strokeLength:
-            raise Exception('Text width (%3.2f) larger than path stroke length (%3.2f)' % (textWidth,strokeLength))
-        
-    def firstTextWidth(self,characters):
-        rawTextWidth=sum([c.width+c.kerning for c in characters])
-        rawTextWidth-=characters[0].kerning # No kerning on 1st
-        rawTextWidth-=characters[0].marginL+characters[-1].marginR # Exclude margins
-        return rawTextWidth
-
-    def plainTextWidth(self,characters):
-        rawTextWidth=self.firstTextWidth(characters)
-        intervals=len(characters)-1
-        textWidth=rawTextWidth+self.extraSpacing*intervals
-        return textWidth
-
-    # LEFT, RIGHT, CENTERED
-    # Just check fit on stroke, kerning of 1st char is not used
-
-    def layoutLeft(self,stroke):
-        textWidth=self.plainTextWidth(self.textCharacters)
-        self.checkFit(textWidth,stroke.length)
-        # compensate for left margin if necessary
-        offset=-self.textCharacters[0].marginL
-        return self.textCharacters,self.extraSpacing,textWidth,offset
-        
-    def layoutRight(self,stroke):
-        textWidth=self.plainTextWidth(self.textCharacters)
-        self.checkFit(textWidth,stroke.length)
-        # compensate for right margin if necessary
-        offset=stroke.length-(textWidth+self.textCharacters[0].marginL)
-        return self.textCharacters,self.extraSpacing,textWidth,offset
-
-    def layoutCenter(self,stroke):
-        textWidth=self.plainTextWidth(self.textCharacters)
-        self.checkFit(textWidth,stroke.length)
-        offset=((stroke.length-textWidth)/2.)-self.textCharacters[0].marginL
-        return self.textCharacters,self.extraSpacing,textWidth,offset
-
-    # FILLED
-    def layoutFilled(self,stroke):
-        # String always fits even if it requires to collapse everything.
-        # Might creash is path shorter that one character width
-        if stroke.closed:
-            # last char abutted on first, so kerning counts and #intervals=#chars
-            # However the margins are always used (all characters have neighbors on both sides)
-            textWidth=sum([c.width+c.kerning for c in self.textCharacters])
-            intervals=len(self.textCharacters)
-        else:
-            # no kerning on 1st, and one less intervals, consider margins
-            textWidth=self.plainTextWidth(self.textCharacters)
-            intervals=len(self.textCharacters)-1
-        offset=-self.textCharacters[0].marginL
-        return self.textCharacters,(stroke.length-textWidth)/intervals,stroke.length,offset
-        
-    # REPEATED
-    def layoutRepeated(self,stroke):
-        if stroke.closed:
-            return self.layoutRepeatedOnClosed(stroke)
-        else:
-            return self.layoutRepeatedOnOpen(stroke)
-        
-    def layoutRepeatedOnClosed(self,stroke):
-        # joiner always used
-        # kerning on 1st included, margins included
-        textUnit=self.textCharacters+self.joinCharacters
-        rawTextUnitWidth=sum([c.width+c.kerning for c in textUnit])
-        textUnitWidth=rawTextUnitWidth+(self.extraSpacing*len(textUnit))
-        # Check we can at least fit one
-        self.checkFit(textUnitWidth,stroke.length)
-        repeat=int(stroke.length/textUnitWidth)
-        # deep copy needed because we update each character with its position
-        actualTextCharacters=[copy.copy(c) for _ in range(repeat) for c in textUnit]
-        rawFullTextLength=rawTextUnitWidth*repeat
-        actualSpacing=(stroke.length-rawFullTextLength)/len(actualTextCharacters)
-        trace("Stroke: %3.2f, Unit: %3.2f, Repeat: %d, Full: %3.2f, actualSpacing: %3.2f" %
-               (stroke.length,textUnitWidth,repeat,rawFullTextLength,actualSpacing))
-        offset=-textUnit[0].marginL
-        return actualTextCharacters, actualSpacing,stroke.length,offset
-        
-    def layoutRepeatedOnOpen(self,stroke):
-        # joiner not used if we can only fit one copy
-        textFirstUnit=self.textCharacters
-        rawTextFirstUnitWidth=self.firstTextWidth(textFirstUnit)
-        textFirstUnitWidth=rawTextFirstUnitWidth+(self.extraSpacing*(len(textFirstUnit)-1))
-        # Check we can at least fit one
-        self.checkFit(textFirstUnitWidth,stroke.length)
-        # Addional repeats: always joiner+text, first character has kerning
-        # And as many intervals as characters
-        textMoreUnit=self.joinCharacters+self.textCharacters
-        rawTextMoreUnitWidth=sum([c.width+c.kerning for c in textMoreUnit])
-        textMoreUnitWidth=rawTextMoreUnitWidth+(self.extraSpacing*len(textMoreUnit))
-        repeat=int((stroke.length-textFirstUnitWidth)/textMoreUnitWidth)
-        # deep copy needed because we update each character with its position
-        actualTextCharacters=[copy.copy(c) for c in textFirstUnit]+[copy.copy(c) for _ in range(repeat) for c in textMoreUnit]
-        rawFullTextLength=rawTextFirstUnitWidth+(rawTextMoreUnitWidth*repeat)
-        actualSpacing=(stroke.length-rawFullTextLength)/(len(actualTextCharacters)-1) 
-        trace("Stroke: %3.2f, First: %3.2f, More: %3.2f, Repeat: %d, Full: %3.2f, actualSpacing: %3.2f" %
-               (stroke.length,textFirstUnitWidth,textMoreUnitWidth,repeat,rawFullTextLength,actualSpacing))
-        offset=-textFirstUnit[0].marginL
-        return actualTextCharacters, actualSpacing,stroke.length,offset
-
-    # Lay out the characters on the stroke, by computing their.position coordinate
-    def layoutOnStroke(self,stroke):
-        layoutFunction=[self.layoutLeft,self.layoutRight,self.layoutCenter,self.layoutFilled,self.layoutRepeated]
-        self.actualCharacters,actualSpacing,textWidth,offset=layoutFunction[self.layout](stroke)
-            
-        self.wiggleXMax=textWidth/len(self.actualCharacters)
-        
-        trace('Stroke length: %3.2f, start offset: %3.2f, actualSpacing: %3.2f, actual text width: %3.2f ' % (stroke.length, offset, actualSpacing, textWidth))
-        
-        # set position for each character (actually position of Pivot/Center of character)
-        for c in self.actualCharacters:
-            position=offset+c.width/2.+c.kerning
-            offset=position+c.width/2.+actualSpacing
-            c.position=position
-            trace(c)
-            
-    # compute final pos for character
-    def computeFinalPos(self,c,stroke):
-        x,y,slope=stroke.getPointAtDist(c.position)
-        if self.keepUpright:
-            tilt=0
+pathCollectorTypes= [OnePathToRuleThemAll,OnePathPerStroke,      TextAndSpacer,                   EachOnItsOwn,
+                     svgCollector(SVGOnePathToRuleThemAll),svgCollector(SVGOnePathPerStroke),
+                     svgCollector(SVGTextAndSpacer),svgCollector(SVGEachOnItsOwn)]
+pathCollectorLabels=["One single path",   "One path per stroke", "Separate text and spacer paths","One path per character",
+                     "SVG file, one single path","SVG file, one path per stroke","SVG file, separate text and spacer paths","SVG file, one path per character"]
+
+
+# Lays out the texts on the strokes of the guide path: a single text on all
+# strokes, or with "multi" one text per stroke. Raises on errors.
+def textsAlongPath(image,guidePath,texts,multi,
+                   joiner,fontName,fontSize,
+                   layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
+                   keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,
+                   backwards,generationType,showBoxes,wiggleSeed):
+    if not fontName:
+        fontName = pdb.gimp_context_get_font()
+    strokes=guidePath.strokes
+    if not strokes:
+        raise Exception('No strokes in path "%s"' % guidePath.name)
+    if multi and len(strokes) != len(texts):
+        raise Exception('Number of strokes in path "%s" (%d) does not match the number of lines of text (%d)' % (guidePath.name,len(strokes),len(texts)))
+    pathText='<multiple>' if multi else texts[0]
+    if joiner:
+        pathName="'%s' + '%s' over <%s>" % (pathText,joiner,guidePath.name)
+    else:
+        pathName="'%s' over <%s>" % (pathText,guidePath.name)
+    pathCollector=pathCollectorTypes[generationType](image,pathName,showBoxes)
+    # Font state is created once, and in "multi" each line only updates the text
+    formatter=Formatter(texts[0],joiner,GimpGlyphProvider(fontName,fontSize),
+            layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
+            keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,wordRender,wiggleSeed)
+    geometryCache=StrokeGeometryCache(guidePath)
+    # Lines of text may need glyphs from Gimp, so "multi" is never laid out in parallel
+    with pathCollector, ParallelLayout(formatter,0 if multi else len(strokes)) as parallelLayout:
+        if parallelLayout.pool:
+            # Strokes laid out in worker processes, only the output is done here
+            strokesPoints=[s.points for s in strokes]
+            for i,placements in enumerate(parallelLayout.placements(strokesPoints,backwards,geometryCache),1):
+                pathCollector.enterStroke(i)
+                formatter.emitChunks([placements],pathCollector)
         else:
-            tilt=slope*180/math.pi
-        
-        wiggleXRange=self.wiggleXMax*self.wiggleXPercent/100.
-        wiggleYRange=self.wiggleYMax*self.wiggleYPercent/100.
+            for i,s in enumerate(strokes,1):
+                if multi and i>1:
+                    formatter.setText(texts[i-1],joiner)
+                stroke=DirectionStroke(s,backwards,geometryCache)
+                pathCollector.enterStroke(i)
+                formatter.layoutOnStroke(stroke,i)
+                formatter.moveCharactersToStroke(stroke,pathCollector)
+    # The tables are not kept for SVG output, that leaves the image unchanged
+    if not getattr(pathCollectorTypes[generationType],'svg',False):
+        geometryCache.save()
 
-        wx=random.uniform(-wiggleXRange,wiggleXRange)
-        wy=random.uniform(-wiggleYRange,wiggleYRange)
-        wtilt=random.uniform(-self.wiggleTheta,self.wiggleTheta)
+def reportError(e):
+    tracer.log('general',TraceLevel.WARNING,'%s',e.args[0])
+    tracer.dump()
+    if debug:
+        traceback.print_exc()
+    pdb.gimp_message(e.args[0])
+
+# Done at the end of each procedure run
+def endRun():
+    workImage.release()
+    glyphCache.save()
+    fontMetrics.report()
 
-        return x+wx*math.cos(slope)-wy*math.sin(slope),y+wy*math.cos(slope)+wx*math.sin(slope),tilt+wtilt
-        
-    def copyStrokes(self,sourcePath,targetPath):
-        for s in sourcePath.strokes:
-            points,closed=s.points
-            stroke = gimp.VectorsBezierStroke(targetPath,points, closed)
-
-    def moveCharacterToStroke(self,c,stroke,pathCollector):
-        if not c.path:
-            return # nothing to do on blank characters
-        
-        x,y,tilt=self.computeFinalPos(c,stroke)
-        trace("%3.2f moved to %3.2f,%3.2f" % (c.position,x,y)) 
-        
-        # Position of NW corner of character box
-        cX=x-c.width/2.
-        cY=y-self.pivotY
-        # Position of pivot in box
-        pX=c.width/2.
-        pY=self.pivotY
-        pathCollector.addCharacter(c.path,cX,cY,pX,pY,tilt,c.ctype)
-        pathCollector.addBox(c.boxPath,cX,cY,pX,pY,tilt,c.ctype)
-            
-    def moveCharactersToStroke(self,stroke,pathCollector):
-        trace("Max wiggle X,Y: %3.2f,%3.2f" % (self.wiggleXMax,self.wiggleYMax))
-        for i,c in enumerate(self.actualCharacters,1):
-            pathCollector.enterCharacter(i,c.character)
-            self.moveCharacterToStroke(c,stroke,pathCollector)
-            
 def textAlongPath(image,guidePath,
                   text,joiner,fontName,fontSize,
                   layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
                   keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,
-                  backwards,generationType,showBoxes):
+                  backwards,generationType,showBoxes,wiggleSeed):
     
+    profiler.start()
     pdb.gimp_image_undo_group_start(image)
     try:
-        if not fontName:
-            fontName = pdb.gimp_context_get_font()
         if not text:
             raise Exception('No text provided')
-        if not len(guidePath.strokes):
-            raise Exception('No strokes in path "%s"' % guidePath.name)
-        if joiner:
-            pathName="'%s' + '%s' over <%s>" % (text,joiner,guidePath.name)
-        else:
-            pathName="'%s' over <%s>" % (text,guidePath.name)
-        pathCollector=pathCollectorTypes[generationType](image,pathName,showBoxes)
-        formatter=Formatter(text,joiner,fontName,fontSize,
-                layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
-                keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta)
-        with pathCollector:
-            for i,s in enumerate(guidePath.strokes,1):
-                stroke=DirectionStroke(s,backwards)
-                pathCollector.enterStroke(i)
-                formatter.layoutOnStroke(stroke)
-                formatter.moveCharactersToStroke(stroke,pathCollector)
+        textsAlongPath(image,guidePath,[text],False,
+                       joiner,fontName,fontSize,
+                       layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
+                       keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,
+                       backwards,generationType,showBoxes,wiggleSeed)
     except Exception as e:
-        trace(e.args[0])
-        if debug:
-            traceback.print_exc()
-        pdb.gimp_message(e.args[0])
+        reportError(e)
+    endRun()
     pdb.gimp_image_undo_group_end(image)
+    reportProfile('ofn-text-along-path',guidePath,text,layout,generationType)
     
 def textAlongPathMulti(image,guidePath,
                   texts,joiner,fontName,fontSize,
                   layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
                   keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,
-                  backwards,generationType,showBoxes):
+                  backwards,generationType,showBoxes,wiggleSeed):
     
+    profiler.start()
     pdb.gimp_image_undo_group_start(image)
     try:
-        if not fontName:
-            fontName = pdb.gimp_context_get_font()
         if not texts:
             raise Exception('No text provided')
-        texts=[t for t in texts.translate(None,'\r').split('\n') if len(t) > 0]
-        if len(guidePath.strokes) != len(texts):
-            raise Exception('Number of strokes in path "%s" (%d) does not match the number of lines of text (%d)' % (guidePath.name,len(guidePath.strokes),len(texts)))
-        if joiner:
-            pathName="'%s' + '%s' over <%s>" % ('<multiple>',joiner,guidePath.name)
-        else:
-            pathName="'%s' over <%s>" % ('<multiple>',guidePath.name)
-        pathCollector=pathCollectorTypes[generationType](image,pathName,showBoxes)
-        with pathCollector:
-            for i,(s,text) in enumerate(zip(guidePath.strokes,texts),1):
-                formatter=Formatter(text,joiner,fontName,fontSize,
-                        layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
-                        keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta)
-                stroke=DirectionStroke(s,backwards)
-                pathCollector.enterStroke(i)
-                formatter.layoutOnStroke(stroke)
-                formatter.moveCharactersToStroke(stroke,pathCollector)
+        lines=[t for t in texts.translate(None,'\r').split('\n') if len(t) > 0]
+        textsAlongPath(image,guidePath,lines,True,
+                       joiner,fontName,fontSize,
+                       layout,useKerning,extraSpacing,pivotYChoice,verticalAdjust,
+                       keepUpright,wiggleXPercent,wiggleYPercent,wiggleTheta,
+                       backwards,generationType,showBoxes,wiggleSeed)
     except Exception as e:
-        trace(e.args[0])
-        if debug:
-            traceback.print_exc()
-        pdb.gimp_message(e.args[0])
+        reportError(e)
+    endRun()
     pdb.gimp_image_undo_group_end(image)
+    reportProfile('ofn-text-along-path-multi',guidePath,texts,layout,generationType)
+
+#----------------------------------------------------
+# Batch
+#
+# The batch procedure runs the jobs of a JSON manifest in a single Gimp
+# process, so the font state and the caches are shared by all the jobs:
+#
+#   gimp -i -b '(python-fu-ofn-text-along-path-batch RUN-NONINTERACTIVE "jobs.json")' -b '(gimp-quit 0)'
+#
+# The manifest is a list of jobs, or an object with "jobs" and "defaults"
+# (settings common to all jobs). Each job is an object with:
+#
+#   - the guide path: "image" (an image file) with "path" (the name of the
+#     path in the image, the active path by default), or "svg" (an SVG file,
+#     read directly, see ofn_text_along_path_svg), with "path" (the id of
+#     the SVG path, all the paths are merged by default)
+#   - "text" (laid out on all the strokes) or "texts" (a list of texts, one 
+#     per stroke)
+#   - "output" (optional): the file written, an XCF file of the image with 
+#     the generated paths, or the SVG file with the SVG generation options
+#   - the settings, named as the parameters of the procedures ("fontName",
+#     "fontSize", "layout", ...), the options ("layout", "pivotYChoice",
+#     "generationType") taking either their index or their label
+#
+# File names are relative to the manifest. Jobs in error are reported and
+# skipped. Strings are passed to Gimp in UTF-8, as it gives them.
+#----------------------------------------------------
+jobKeys=set(['image','path','svg','text','texts','output'])
+
+def jobFileName(job,key,baseDir):
+    return toBytes(os.path.join(baseDir,os.path.expanduser(job[key])))
+
+# Image and guide path of a job, and the file they come from. The
+# image of an SVG guide is a new image of the size of the SVG file.
+def loadGuide(job,baseDir):
+    if 'svg' in job:
+        fileName=jobFileName(job,'svg',baseDir)
+        width,height,paths=readSVGPaths(fileName)
+        strokes=[stroke for pathId,pathStrokes in paths if job.get('path') in (None,pathId) for stroke in pathStrokes]
+        if not strokes:
+            raise Exception('No guide path in "%s"' % fileName)
+        image=gimp.Image(int(math.ceil(width)),int(math.ceil(height)),RGB)
+        guide=gimp.Vectors(image,toBytes(job.get('path') or os.path.basename(fileName)))
+        for points,closed in strokes:
+            gimp.VectorsBezierStroke(guide,points,closed)
+        pdb.gimp_image_insert_vectors(image,guide,None,0)
+        guides=[guide]
+    elif 'image' in job:
+        fileName=jobFileName(job,'image',baseDir)
+        image=pdb.gimp_file_load(fileName,fileName)
+        if 'path' in job:
+            guides=[v for v in image.vectors if v.name==toBytes(job['path'])]
+        else:
+            guides=[image.active_vectors or (image.vectors and image.vectors[0])]
+    else:
+        raise Exception('No "image" or "svg" guide')
+    image.disable_undo()
+    if not (guides and guides[0]):
+        pdb.gimp_image_delete(image)
+        raise Exception('No guide path in "%s"' % fileName)
+    return image,guides[0],fileName
+
+# Value of a setting from the manifest, checked against its parameter
+# registration, so that a wrong value is reported with its setting name
+numberTypes=(int,long,float)
+
+def settingValue(reg,value):
+    kind,name=reg[0],reg[1]
+    if kind in (PF_STRING,PF_FONT):
+        if not isinstance(value,basestring):
+            raise Exception('Setting "%s" should be a string' % name)
+        return toBytes(value)
+    if kind==PF_TOGGLE:
+        if value not in (True,False): # Also 0 and 1
+            raise Exception('Setting "%s" should be true or false' % name)
+        return bool(value)
+    if kind==PF_OPTION:
+        labels=reg[4]
+        if isinstance(value,basestring):
+            if toBytes(value) not in labels:
+                raise Exception('Unknown %s "%s"' % (name,toBytes(value)))
+            return labels.index(toBytes(value))
+        if isinstance(value,bool) or not isinstance(value,(int,long)) or not 0<=value<len(labels):
+            raise Exception('Setting "%s" should be one of %s, or a number from 0 to %d' % (name,', '.join('"%s"' % l for l in labels),len(labels)-1))
+        return value
+    if isinstance(value,bool) or not isinstance(value,numberTypes):
+        raise Exception('Setting "%s" should be a number' % name)
+    if kind==PF_INT:
+        if value!=int(value):
+            raise Exception('Setting "%s" should be an integer' % name)
+        return int(value)
+    if kind==PF_SPINNER:
+        low,high,_=reg[4]
+        if not low<=value<=high:
+            raise Exception('Setting "%s" should be between %s and %s' % (name,low,high))
+    return float(value)
+
+# Settings of a job, from the defaults of the procedure parameters,
+# the defaults of the manifest, and the job
+def jobSettings(job,manifestDefaults):
+    regs=dict((reg[1],reg) for reg in regSettings)
+    settings=dict((reg[1],reg[3]) for reg in regSettings)
+    for values in (manifestDefaults,job):
+        for key,value in values.items():
+            if key in jobKeys:
+                continue
+            if key not in settings:
+                raise Exception('Unknown setting "%s"' % key)
+            settings[key]=settingValue(regs[key],value)
+    return settings
+
+def runJob(job,manifestDefaults,baseDir):
+    global svgOutputFile
+    settings=jobSettings(job,manifestDefaults)
+    if 'texts' in job:
+        if not (isinstance(job['texts'],list) and all(isinstance(t,basestring) for t in job['texts'])):
+            raise Exception('"texts" should be a list of strings')
+        texts,multi=[toBytes(t) for t in job['texts']],True
+    elif job.get('text'):
+        if not isinstance(job['text'],basestring):
+            raise Exception('"text" should be a string')
+        texts,multi=[toBytes(job['text'])],False
+    else:
+        raise Exception('No text provided')
+    image,guidePath,guideFile=loadGuide(job,baseDir)
+    svg=getattr(pathCollectorTypes[settings['generationType']],'svg',False)
+    try:
+        if 'output' in job:
+            output=jobFileName(job,'output',baseDir)
+        else:
+            output=os.path.splitext(guideFile)[0]+('-text-along-path.svg' if svg else '-text-along-path.xcf')
+        svgOutputFile=output if svg else None
+        textsAlongPath(image,guidePath,texts,multi,**settings)
+        if not svg:
+            if not image.layers: # Image of an SVG guide, a layer is needed to save it
+                layer=gimp.Layer(image,'Background',image.width,image.height,RGBA_IMAGE,100,NORMAL_MODE)
+                image.add_layer(layer,0)
+            pdb.gimp_xcf_save(0,image,image.active_drawable,output,output)
+        reportProfile('ofn-text-along-path-batch',guidePath,texts,settings['layout'],settings['generationType'])
+    finally:
+        svgOutputFile=None
+        pdb.gimp_image_delete(image)
+    return output
+
+def textAlongPathBatch(manifestFile):
+    done,failed=0,0
+    try:
+        with open(manifestFile) as f:
+            manifest=json.load(f)
+        if isinstance(manifest,list):
+            manifest={'jobs':manifest}
+        baseDir=os.path.dirname(os.path.abspath(manifestFile))
+        for i,job in enumerate(manifest.get('jobs',[]),1):
+            profiler.start()
+            try:
+                output=runJob(job,manifest.get('defaults',{}),baseDir)
+                tracer.log('general',TraceLevel.INFO,'Job %d written to %s',i,output)
+                done+=1
+            except Exception as e:
+                reportError(Exception('Job %d: %s' % (i,e.args[0] if e.args else e)))
+                failed+=1
+    except Exception as e:
+        reportError(e)
+    endRun()
+    pdb.gimp_message('Text along path batch: %d jobs done, %d failed' % (done,failed))
 
 ### Registration
 
@@ -756,9 +932,16 @@ def textAlongPathMulti(image,guidePath,
 regWiggleXPercent=  (PF_SPINNER, 'wiggleXPercent',  'Lateral wiggle (%):',      0,(0, 100, 1))
 regWiggleYPercent=  (PF_SPINNER, 'wiggleYPercent',  'Vertical wiggle (%):',     0,(0, 100, 1))
 regWiggleTheta=     (PF_SPINNER, 'wiggleTheta',     'Tilt wiggle (°):',         0,(0, 90, 1))
+regWiggleSeed=      (PF_INT,     'wiggleSeed',      'Wiggle seed (0: random):', 0)
 regBackwards=       (PF_TOGGLE,  'backwards',       'Reverse stroke direction:',False)
 regPathGeneration=  (PF_OPTION,  'generationType',  'Generate:',                0,pathCollectorLabels)
 regShowBoxes=       (PF_TOGGLE,  'showBoxes',       'Show boxes as paths:',     False)
+regManifest=        (PF_STRING,  'manifest',        'Manifest (JSON):',         '')
+
+# Settings of the batch jobs
+regSettings=[regJoiner,regFontName,regFontSize,regLayout,regUseKerning,regExtraSpacing,regHeightReference,
+             regVerticalAdjust,regKeepUpright,regWiggleXPercent,regWiggleYPercent,regWiggleTheta,
+             regBackwards,regPathGeneration,regShowBoxes,regWiggleSeed]
 
 register(
     'ofn-text-along-path',
@@ -787,7 +970,8 @@ def textAlongPathMulti(image,guidePath,
         regWiggleTheta,
         regBackwards,
         regPathGeneration,
-        regShowBoxes
+        regShowBoxes,
+        regWiggleSeed
     ],
     [],
     textAlongPath,
@@ -821,11 +1005,28 @@ def textAlongPathMulti(image,guidePath,
         regWiggleTheta,
         regBackwards,
         regPathGeneration,
-        regShowBoxes
+        regShowBoxes,
+        regWiggleSeed
     ],
     [],
     textAlongPathMulti,
     menu='<Vectors>/Tools',
 )
+
+register(
+    'ofn-text-along-path-batch',
+    'Text along path, jobs from a JSON manifest'+whoiam,
+    'Text along path, jobs from a JSON manifest',
+    'Ofnuts',
+    'Ofnuts',
+    '2017',
+    'Text along path (batch)',
+    '',
+    [
+        regManifest
+    ],
+    [],
+    textAlongPathBatch,
+)
         
 main()